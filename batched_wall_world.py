@@ -0,0 +1,64 @@
+import numpy as np
+
+from vector_geometry import nearest_hits
+
+
+class BatchedWallWorld(object):
+    """Steps many robots through the same walls at once. Positions live in
+    a (K, 2) array and every move and range reading is resolved for all K
+    robots with one array computation against the shared wall array."""
+    direction_names = ('north', 'east', 'south', 'west')
+    direction_vectors = np.array([
+        (0, 1),
+        (1, 0),
+        (0, -1),
+        (-1, 0),
+        ], dtype=np.float64)
+
+    COLLISION_DISTANCE = 0.1
+
+    def __init__(self, dimensions, walls, robot_positions):
+        self.dimensions = np.asarray(dimensions, dtype=np.float64)
+        self.walls = np.asarray(walls, dtype=np.float64).reshape(-1, 4)
+        self.robot_positions = np.array(robot_positions, dtype=np.float64).reshape(-1, 2)
+        assert self.in_boundaries(self.robot_positions).all()
+        # rays are as long as World.distance_in_direction makes them
+        self.ray_offsets = self.direction_vectors * self.dimensions * 2
+        self.ray_lengths = np.abs(self.ray_offsets).sum(axis=1)
+
+    @classmethod
+    def from_mdp(cls, mdp, robot_positions):
+        return cls(mdp.dimensions, mdp.world.wall_array(), robot_positions)
+
+    def in_boundaries(self, positions):
+        return ((positions >= 0) & (positions <= self.dimensions)).all(axis=1)
+
+    def move_robots(self, destinations):
+        """Vectorized World.move_robot: robots that would cross a wall stop
+        a short distance before the crossing"""
+        destinations = np.asarray(destinations, dtype=np.float64).reshape(-1, 2)
+        assert self.in_boundaries(destinations).all()
+        movement = destinations - self.robot_positions
+        hits = nearest_hits(self.robot_positions, destinations, self.walls)
+        blocked = np.isfinite(hits)
+        # unblocked robots have an inf hit, which must not meet a zero move
+        hits = np.where(blocked, hits, 0.0)
+        stopped = self.robot_positions + movement * hits[:, None] - self.COLLISION_DISTANCE * movement
+        self.robot_positions = np.where(blocked[:, None], stopped, destinations)
+        return self.robot_positions
+
+    def readings(self):
+        """(K, 4) distances to the nearest wall, in direction_names order"""
+        starts = np.repeat(self.robot_positions, len(self.direction_vectors), axis=0)
+        ends = starts + np.tile(self.ray_offsets, (len(self.robot_positions), 1))
+        hits = nearest_hits(starts, ends, self.walls).reshape(-1, len(self.direction_vectors))
+        assert np.isfinite(hits).all()
+        return hits * self.ray_lengths
+
+    def observations(self):
+        """(K, 6) rows of x, y followed by the readings"""
+        return np.hstack((self.robot_positions, self.readings()))
+
+    def step(self, destinations):
+        self.move_robots(destinations)
+        return self.observations()
@@ -0,0 +1,259 @@
+"""Times the simulation and mapping hot paths over a range of scales.
+
+    python benchmarks.py --output results.json
+    python benchmarks.py --quick --compare results.json
+
+Results are written as JSON (one entry per benchmark and scale) so that
+runs on different commits can be compared with --compare."""
+import argparse
+import json
+import os
+import platform
+import time
+from random import Random
+
+import numpy as np
+
+from wall_world import Point
+from wall_world import Wall
+from wall_world_mdp import WallWorldMDP
+from world_generator import generate_world
+from mapping_agent import MappingAgent
+from forget_map_context import forget_map_context
+from merge_maps import similarity_score
+
+
+SCALES = {
+    'wall_count': [35, 350, 3500],
+    'bins': [50, 100, 200],
+    'steps': [100, 1000],
+    'generated_walls': [35, 3500, 100000],
+    }
+
+QUICK_SCALES = {
+    'wall_count': [35, 350],
+    'bins': [50, 100],
+    'steps': [100],
+    'generated_walls': [35, 3500],
+    }
+
+START_POSITION = (7.5, 8.5)
+
+
+def make_mdp(wall_count, seed=0):
+    """WallWorldMDP with random short walls added until it has wall_count"""
+    mdp = WallWorldMDP(START_POSITION)
+    rand = Random(seed)
+    world = mdp.world
+    while world.wall_count < wall_count:
+        x, y = rand.uniform(1, 11), rand.uniform(1, 11)
+        end = Point(
+            min(max(x + rand.uniform(-1, 1), 1), 11),
+            min(max(y + rand.uniform(-1, 1), 1), 11),
+            )
+        world.add_wall(Wall((Point(x, y), end)))
+    return mdp
+
+
+def make_generated_mdp(wall_count, seed=0):
+    """WallWorldMDP on a generated world that grows with wall_count, at
+    roughly the wall density of wall_list.txt"""
+    side = 12 * max(1.0, (wall_count / 35.0) ** 0.5)
+    world = generate_world((side, side), seed=seed, wall_count=wall_count)
+    return world.make_mdp()
+
+
+def make_agent(mdp, bins, seed=0):
+    agent_class = type('BenchmarkAgent', (MappingAgent,), {'BINS_PER_DIMENSION': (bins, bins)})
+    return agent_class(mdp.spec(), seed=seed)
+
+
+def readings(world):
+    return dict(
+        (MappingAgent.direction_bases[name], world.distance_in_direction(direction))
+        for name, direction in world.directions.items()
+        )
+
+
+def run_steps(mdp, agent, steps):
+    world = mdp.world
+    for _ in xrange(steps):
+        position = (world.robot_location.x, world.robot_location.y)
+        destination = agent.act(position, readings(world))
+        world.robot_location = world.move_robot(Point(destination[0], destination[1]))
+
+
+def time_calls(function, repeat, number):
+    """Best and mean seconds per call over repeat batches of number calls"""
+    timings = []
+    for _ in xrange(repeat):
+        start = time.time()
+        for _ in xrange(number):
+            function()
+        timings.append((time.time() - start) / number)
+    return min(timings), sum(timings) / len(timings)
+
+
+def bench_move_robot(wall_count):
+    mdp = make_mdp(wall_count)
+    world = mdp.world
+    rand = Random(1)
+    destinations = [Point(rand.uniform(1, 11), rand.uniform(1, 11)) for _ in xrange(64)]
+    state = {'index': 0}
+
+    def move():
+        world.robot_location = world.move_robot(destinations[state['index'] % len(destinations)])
+        state['index'] += 1
+    return move
+
+
+def bench_distance_in_direction(wall_count):
+    world = make_mdp(wall_count).world
+    direction = world.directions['east']
+    return lambda: world.distance_in_direction(direction)
+
+
+def bench_generated_move_robot(wall_count):
+    mdp = make_generated_mdp(wall_count)
+    world = mdp.world
+    rand = Random(1)
+    start = world.robot_location
+    destinations = [
+        Point(start.x + rand.uniform(-3, 3), start.y + rand.uniform(-3, 3))
+        for _ in xrange(64)
+        ]
+    state = {'index': 0}
+
+    def move():
+        # hop out from the start position so the robot stays in one area
+        world.robot_location = start
+        world.robot_location = world.move_robot(destinations[state['index'] % len(destinations)])
+        state['index'] += 1
+    return move
+
+
+def bench_make_observation(wall_count):
+    world = make_mdp(wall_count).world
+    return world.make_observation
+
+
+def bench_update_maps(bins):
+    mdp = make_mdp(35)
+    agent = make_agent(mdp, bins)
+    position = START_POSITION
+    observed_bases = readings(mdp.world)
+    return lambda: agent.update_maps(position, agent.log_map, agent.observed_map, observed_bases)
+
+
+def bench_proba_map(bins):
+    mdp = make_mdp(35)
+    agent = make_agent(mdp, bins)
+    run_steps(mdp, agent, 50)
+    agent.proba_map()
+    # bins one scan leaves stale; only the refresh of those is timed
+    agent.update_maps(START_POSITION, agent.log_map, agent.observed_map, readings(mdp.world))
+    scan_bins = list(agent.stale_bins)
+
+    def refresh_after_scan():
+        agent.stale_bins = list(scan_bins)
+        agent.proba_map()
+    return refresh_after_scan
+
+
+def explored_maps(bins, seed):
+    mdp = make_mdp(35, seed)
+    agent = make_agent(mdp, bins, seed)
+    run_steps(mdp, agent, 300)
+    return agent.proba_map().T, agent.observed_map.T
+
+
+def bench_forget_map_context(bins):
+    proba_map, observed_map = explored_maps(bins, 0)
+    rand = Random(0)
+    return lambda: forget_map_context(proba_map, observed_map, rand)
+
+
+def bench_similarity_score(bins):
+    first = forget_map_context(*explored_maps(bins, 0), rand=Random(0))
+    second = forget_map_context(*explored_maps(bins, 1), rand=Random(1))
+    return lambda: similarity_score(first, second)
+
+
+def bench_episode(steps):
+    def episode():
+        mdp = make_mdp(35)
+        run_steps(mdp, make_agent(mdp, 50), steps)
+    return episode
+
+
+BENCHMARKS = [
+    ('World.move_robot', 'wall_count', bench_move_robot, 200),
+    ('World.distance_in_direction', 'wall_count', bench_distance_in_direction, 200),
+    ('World.make_observation', 'wall_count', bench_make_observation, 100),
+    ('World.move_robot (generated)', 'generated_walls', bench_generated_move_robot, 200),
+    ('MappingAgent.update_maps', 'bins', bench_update_maps, 100),
+    ('MappingAgent.proba_map', 'bins', bench_proba_map, 100),
+    ('forget_map_context', 'bins', bench_forget_map_context, 50),
+    ('similarity_score', 'bins', bench_similarity_score, 1),
+    ('episode', 'steps', bench_episode, 1),
+    ]
+
+
+def run_benchmarks(scales, repeat, selected=None):
+    results = []
+    for name, parameter, setup, number in BENCHMARKS:
+        if selected and not any(pattern in name for pattern in selected):
+            continue
+        for value in scales[parameter]:
+            best, mean = time_calls(setup(value), repeat, number)
+            results.append({
+                'name': name,
+                'parameter': parameter,
+                'value': value,
+                'best': best,
+                'mean': mean,
+                })
+            print '%-30s %-10s %8s %12.6f s' % (name, parameter, value, best)
+    return results
+
+
+def compare(previous, current):
+    before = dict(((r['name'], r['value']), r['best']) for r in previous['results'])
+    for result in current['results']:
+        key = (result['name'], result['value'])
+        if key in before:
+            print '%-30s %8s %12.6f -> %12.6f  x%.2f' % (
+                result['name'],
+                result['value'],
+                before[key],
+                result['best'],
+                before[key] / result['best'] if result['best'] > 0 else float('inf'),
+                )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--quick', action='store_true', help='smaller scales')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='*', help='run benchmarks whose name contains one of these')
+    args = parser.parse_args()
+
+    # World reads wall_list.txt from the working directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    np.random.seed(0)
+    results = {
+        'timestamp': time.time(),
+        'machine': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            },
+        'results': run_benchmarks(QUICK_SCALES if args.quick else SCALES, args.repeat, args.only),
+        }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), results)
@@ -1,9 +1,18 @@
+import numpy as np
+
+
 def discretize(val, min_val, max_val, bin_count):
-    discrete_val = int(bin_count * normalize(
+    """Bin index of val, or an array of bin indices if val is an array"""
+    scaled_val = bin_count * normalize(
         val,
         min_val,
         max_val,
-        ))
+        )
+    if np.ndim(scaled_val) == 0:
+        discrete_val = int(scaled_val)
+    else:
+        # astype truncates toward zero, same as int()
+        discrete_val = scaled_val.astype(int)
     return enforce_bins(
         discrete_val,
         0,
@@ -12,10 +21,14 @@ def discretize(val, min_val, max_val, bin_count):
 
 
 def normalize(val, min_val, max_val):
-    return (float(val) - min_val) / (float(max_val) - min_val)
+    if np.ndim(val) == 0:
+        return (float(val) - min_val) / (float(max_val) - min_val)
+    return (np.asarray(val, dtype=np.float64) - min_val) / (float(max_val) - min_val)
 
 
 def enforce_bins(val, min_bin, max_bin):
+    if np.ndim(val) > 0:
+        return np.clip(val, min_bin, max_bin)
     if val < min_bin:
         val = min_bin
     elif val > max_bin:
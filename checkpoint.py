@@ -0,0 +1,96 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+def save_checkpoint(directory, agent, robot_position, steps_completed):
+    """Writes the agent's maps and random state plus the robot position as
+    .npy files and a small JSON file. Everything goes to a scratch
+    directory first, which then replaces the old checkpoint, so a crash
+    mid-write leaves the previous checkpoint usable."""
+    scratch = directory.rstrip(os.sep) + '.partial'
+    if os.path.exists(scratch):
+        shutil.rmtree(scratch)
+    os.makedirs(scratch)
+
+    np.save(os.path.join(scratch, 'log_map.npy'), agent.log_map)
+    np.save(os.path.join(scratch, 'observed_map.npy'), agent.observed_map)
+    generator, keys, position, has_gauss, cached_gaussian = agent.np_rand.get_state()
+    np.save(os.path.join(scratch, 'numpy_rng_keys.npy'), keys)
+    state = {
+        'robot_position': [float(robot_position[0]), float(robot_position[1])],
+        'steps_completed': steps_completed,
+        'numpy_rng': [generator, position, has_gauss, cached_gaussian],
+        }
+    with open(os.path.join(scratch, 'state.json'), 'w') as f:
+        json.dump(state, f)
+
+    # the old checkpoint is moved aside rather than deleted, so there is
+    # always a complete one on disk for load_checkpoint to fall back on
+    previous = previous_directory(directory)
+    if os.path.exists(directory):
+        if os.path.exists(previous):
+            shutil.rmtree(previous)
+        os.rename(directory, previous)
+    os.rename(scratch, directory)
+    if os.path.exists(previous):
+        shutil.rmtree(previous)
+
+
+def previous_directory(directory):
+    return directory.rstrip(os.sep) + '.old'
+
+
+def load_checkpoint(directory, mmap_mode='r'):
+    """Reads a checkpoint back. The arrays are memory-mapped by default, so
+    nothing is copied until they are used. If save_checkpoint was cut off
+    between moving the old checkpoint aside and putting the new one in
+    place, the old one is read instead."""
+    if not os.path.exists(os.path.join(directory, 'state.json')):
+        previous = previous_directory(directory)
+        if os.path.exists(os.path.join(previous, 'state.json')):
+            directory = previous
+    with open(os.path.join(directory, 'state.json'), 'r') as f:
+        checkpoint = json.load(f)
+    for name in ('log_map', 'observed_map', 'numpy_rng_keys'):
+        checkpoint[name] = np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+    return checkpoint
+
+
+def restore_agent(agent, checkpoint):
+    agent.restore_maps(np.array(checkpoint['log_map']), np.array(checkpoint['observed_map']))
+    # checkpoints from before sampling moved to numpy also carry a
+    # 'python_rng' entry, which nothing uses any more
+    generator, position, has_gauss, cached_gaussian = checkpoint['numpy_rng']
+    agent.np_rand.set_state((
+        str(generator),
+        np.array(checkpoint['numpy_rng_keys']),
+        position,
+        has_gauss,
+        cached_gaussian,
+        ))
+
+
+class MapStackWriter(object):
+    """Streams equally shaped maps into one .npy file that can later be
+    opened zero-copy with open_map_stack"""
+    def __init__(self, file_name, count, shape, dtype=np.float64):
+        self.stack = np.lib.format.open_memmap(
+            file_name,
+            mode='w+',
+            dtype=dtype,
+            shape=(count,) + tuple(shape),
+            )
+
+    def write(self, index, map_to_write):
+        self.stack[index] = map_to_write
+
+    def close(self):
+        self.stack.flush()
+        del self.stack
+
+
+def open_map_stack(file_name):
+    return np.load(file_name, mmap_mode='r')
@@ -0,0 +1,213 @@
+"""Precomputed north/east/south/west range readings for a static set of
+walls.
+
+The world is cut into square cells of side resolution. For every cell
+and direction the field stores which wall a reading taken from anywhere
+in the cell must hit first, so a reading becomes a table lookup plus one
+exact line intersection. A cell only gets a wall when that is guaranteed:
+going east, say, from a cell spanning [x0, x1] x [y0, y1],
+
+    - the rays east from (x0, y0) and (x0, y1) both hit the same wall W,
+      beyond x1,
+    - no wall crosses the cell's west side, and
+    - no wall endpoint lies in the rectangle from x0 to the farther of the
+      two hits, between y0 and y1.
+
+Then every wall entering that rectangle in front of W would have had to
+cut one of the two rays first, so W is the first hit for any ray in the
+band. Everything else is marked -1 and World falls back to raycasting.
+Endpoints are counted per cell, so the check is conservative by up to a
+cell.
+
+The table is built a tile of TILE_CELLS x TILE_CELLS cells at a time, the
+first time a reading is taken in that tile, so its memory follows the
+area the robot actually visits rather than the size of the world. Apart
+from the tiles, only per-wall data is kept."""
+import numpy as np
+
+from vector_geometry import first_hits
+
+
+# endpoints this close to a cell boundary count for the cells on both sides
+BOUNDARY_TOLERANCE = 1e-9
+
+# direction components -> (axis the rays run along, sign)
+DIRECTION_AXES = {
+    (0, 1): (1, 1),
+    (1, 0): (0, 1),
+    (0, -1): (1, -1),
+    (-1, 0): (0, -1),
+    }
+DIRECTION_FOR = dict((axes, components) for components, axes in DIRECTION_AXES.items())
+
+
+class DistanceField(object):
+    TILE_CELLS = 64
+
+    def __init__(self, walls, dimensions, resolution):
+        self.resolution = float(resolution)
+        self.dimensions = dimensions
+        self.shape = (
+            int(np.ceil(dimensions[0] / self.resolution)),
+            int(np.ceil(dimensions[1] / self.resolution)),
+            )
+        self.walls = np.asarray(walls, dtype=np.float64).reshape(-1, 4)
+        # plain floats are much quicker than numpy scalars in the query
+        self.wall_rows = [tuple(row) for row in self.walls.tolist()]
+        # extent of every wall across each axis, to find the walls a line
+        # of corners can hit
+        self.spans = [
+            (np.minimum(self.walls[:, axis], self.walls[:, axis + 2]),
+             np.maximum(self.walls[:, axis], self.walls[:, axis + 2]))
+            for axis in (0, 1)
+            ]
+        self.endpoint_keys = self.endpoint_cell_keys()
+        # tile key -> {direction components: wall index per cell}
+        self.tiles = {}
+
+    def wall_index(self, x, y, components):
+        """Row of the wall a reading from (x, y) in the direction with
+        these components hits first, or -1 if it has to be raycast"""
+        col = min(max(int(x / self.resolution), 0), self.shape[0] - 1)
+        row = min(max(int(y / self.resolution), 0), self.shape[1] - 1)
+        key = (col // self.TILE_CELLS, row // self.TILE_CELLS)
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self.tiles[key] = self.build_tile(key)
+        return tile[components].item(col % self.TILE_CELLS, row % self.TILE_CELLS)
+
+    def stable_fraction(self):
+        """Share of cell and direction pairs answered without raycasting,
+        over the tiles built so far"""
+        tables = [walls for tile in self.tiles.values() for walls in tile.values()]
+        if not tables:
+            return 0.0
+        return float(sum(np.count_nonzero(walls >= 0) for walls in tables)) / sum(walls.size for walls in tables)
+
+    @property
+    def nbytes(self):
+        return sum(walls.nbytes for tile in self.tiles.values() for walls in tile.values())
+
+    def build_tile(self, key):
+        low = (key[0] * self.TILE_CELLS, key[1] * self.TILE_CELLS)
+        high = (min(low[0] + self.TILE_CELLS, self.shape[0]), min(low[1] + self.TILE_CELLS, self.shape[1]))
+        corners = (np.arange(low[0], high[0] + 1), np.arange(low[1], high[1] + 1))
+        # first hit (distance, wall) going each way from every corner of
+        # the tile's cells
+        corner_hits = dict(
+            (components, self.corner_hits(corners, axis, sign))
+            for components, (axis, sign) in DIRECTION_AXES.items()
+            )
+        cols, rows = np.meshgrid(
+            np.arange(low[0], high[0]),
+            np.arange(low[1], high[1]),
+            indexing='ij',
+            )
+        return dict(
+            (components, self.stable_walls(corner_hits, low, cols, rows, axis, sign))
+            for components, (axis, sign) in DIRECTION_AXES.items()
+            )
+
+    def corner_hits(self, corners, axis, sign):
+        """(distances, wall indices) of the first hit along axis from the
+        corners with the given column and row indices, as arrays shaped
+        like the grid of corners. Rays only need the walls spanning their
+        line, so each line of corners is one sweep."""
+        positions = [indices * self.resolution for indices in corners]
+        length = self.dimensions[axis] * 2
+        distances = np.empty((len(positions[0]), len(positions[1])))
+        indices = np.empty(distances.shape, dtype=np.intp)
+        other = 1 - axis
+        low, high = self.spans[other]
+        for line, position in enumerate(positions[other]):
+            candidates = np.flatnonzero((low <= position) & (position <= high))
+            starts = np.empty((len(positions[axis]), 2))
+            starts[:, axis] = positions[axis]
+            starts[:, other] = position
+            ends = starts.copy()
+            ends[:, axis] += sign * length
+            hits, hit_indices = first_hits(starts, ends, self.walls[candidates])
+            found = hit_indices >= 0
+            hit_indices[found] = candidates[hit_indices[found]]
+            target = (slice(None), line) if axis == 0 else (line, slice(None))
+            distances[target] = hits * length
+            indices[target] = hit_indices
+        return distances, indices
+
+    def endpoint_cell_keys(self):
+        """For each axis, the sorted keys line * cells_along + cell of every
+        closed cell a wall endpoint is in, where cell runs along the axis
+        and line across it, so endpoints_between is two binary searches"""
+        points = np.concatenate((self.walls[:, :2], self.walls[:, 2:])) / self.resolution
+        ranges = []
+        for axis in (0, 1):
+            first = np.ceil(points[:, axis] - BOUNDARY_TOLERANCE).astype(np.intp) - 1
+            last = np.floor(points[:, axis] + BOUNDARY_TOLERANCE).astype(np.intp)
+            ranges.append((
+                np.clip(first, 0, self.shape[axis] - 1),
+                np.clip(last, 0, self.shape[axis] - 1),
+                ))
+        # a point is in at most two cells along each axis
+        cells = []
+        for col_offset in (0, 1):
+            for row_offset in (0, 1):
+                cols = ranges[0][0] + col_offset
+                rows = ranges[1][0] + row_offset
+                valid = (cols <= ranges[0][1]) & (rows <= ranges[1][1])
+                cells.append((cols[valid], rows[valid]))
+        cols = np.concatenate([c for c, _ in cells]).astype(np.int64)
+        rows = np.concatenate([r for _, r in cells]).astype(np.int64)
+        return (
+            np.sort(rows * self.shape[0] + cols),
+            np.sort(cols * self.shape[1] + rows),
+            )
+
+    def endpoints_between(self, axis, lines, first_cells, last_cells):
+        """Number of endpoint cells on each line across axis from
+        first_cells to last_cells along it, both included"""
+        keys = self.endpoint_keys[axis]
+        base = lines.astype(np.int64) * self.shape[axis]
+        return (
+            np.searchsorted(keys, base + last_cells, side='right') -
+            np.searchsorted(keys, base + first_cells, side='left')
+            )
+
+    def stable_walls(self, corner_hits, low, cols, rows, axis, sign):
+        other = 1 - axis
+        distances, indices = corner_hits[DIRECTION_FOR[(axis, sign)]]
+        side_distances = corner_hits[DIRECTION_FOR[(other, 1)]][0]
+        along = cols if axis == 0 else rows
+        # the corners the band's two edge rays start from, as indices into
+        # the tile's corner arrays
+        start = along + (1 if sign < 0 else 0)
+        edges = []
+        for offset in (0, 1):
+            corner = [cols, rows]
+            corner[axis] = start
+            corner[other] = corner[other] + offset
+            edges.append((corner[0] - low[0], corner[1] - low[1]))
+        first_distance = distances[edges[0]]
+        second_distance = distances[edges[1]]
+        wall = indices[edges[0]]
+        beyond = self.resolution * (1 + BOUNDARY_TOLERANCE)
+        stable = (
+            (wall >= 0) & (wall == indices[edges[1]]) &
+            (first_distance > beyond) & (second_distance > beyond) &
+            (side_distances[edges[0]] > beyond)
+            )
+
+        # no endpoints in the swept rectangle
+        reach = np.maximum(first_distance, second_distance)
+        reach[~stable] = 0
+        origin = start * self.resolution
+        far = origin + sign * reach
+        far_cell = np.floor(far / self.resolution + sign * BOUNDARY_TOLERANCE).astype(np.intp)
+        far_cell = np.clip(far_cell, 0, self.shape[axis] - 1)
+        swept = self.endpoints_between(
+            axis,
+            rows if axis == 0 else cols,
+            np.minimum(along, far_cell),
+            np.maximum(along, far_cell),
+            )
+        stable &= swept == 0
+        return np.where(stable, wall, -1).astype(np.int32)
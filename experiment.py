@@ -1,8 +1,9 @@
+import json
 import math
 import sys
-import matplotlib as mp
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
+import threading
+from multiprocessing import Pool
+from multiprocessing import Process
 import numpy as np
 
 from messages import EpisodeTerminationSignal
@@ -12,9 +13,23 @@ from messages import AgentUpdate
 from messages import EnvironmentUpdate
 from environments import Environment
 from dill_io import save_dill
+from checkpoint import save_checkpoint
+from checkpoint import load_checkpoint
+from checkpoint import restore_agent
+from checkpoint import MapStackWriter
 
 from forget_map_context import forget_map_context
 from merge_maps import merge_maps
+from merge_maps import MapAggregator
+from batched_wall_world import BatchedWallWorld
+from instrumentation import Profiler
+from instrumentation import NULL_PROFILER
+from rendering import draw_map
+from rendering import render_map
+from shared_map import SharedMap
+from shared_map import SharedMappingAgent
+from shared_map import MapReducer
+from shared_map import run_robot
 
 class Experiment(object):
     def __init__(self, agent_class_name, agent_module_path, mdp_class_name, mdp_module_path):
@@ -25,21 +40,32 @@ class Experiment(object):
         self.agent_class = agent_class
         self.mdp_class = mdp_class
 
-    def run_episodes(self, num_cycles, explore_per_cycle, exploit_per_cycle, steps_per_episode):
-        maps = []
-        with open('robot_start_positions.txt', 'r') as positions:
-            positions_strings = positions.readlines()
-        split_coordinates = [position.split(',') for position in positions_strings]
-        position_coordinates = []
-        for position in split_coordinates:
-            position_coordinates.append([float(coord.strip()) + 1 for coord in position])
+    def run_episodes(self, num_cycles, explore_per_cycle, exploit_per_cycle, steps_per_episode, profile_file=None, on_episode=None, aggregator=None):
+        """With profile_file, every episode is profiled and the per-episode
+        timers and counters are written there as JSON at the end.
+
+        Each episode's map is folded into a MapAggregator as soon as the
+        episode ends rather than kept until the end; on_episode, if given, is
+        called with (start_location, aggregator) after each fold so partial
+        results can be looked at while the sweep runs."""
+        if aggregator is None:
+            aggregator = MapAggregator(max_shape=fused_map_extent(self.agent_class(self.spec)))
+        profiles = []
+        position_coordinates = read_start_positions('robot_start_positions.txt')
         for start_location in position_coordinates:
             # print start_location
             agent = self.agent_class(self.spec)
             episode = Episode(agent, self.mdp_class, FreezeExploration(False), FreezeLearning(False), start_location)
-            episode.run(steps_per_episode)
+            profiler = Profiler() if profile_file is not None else None
+            episode.run(steps_per_episode, profiler=profiler)
+            if profiler is not None:
+                profile = profiler.report()
+                profile['start_location'] = start_location
+                profiles.append(profile)
             free_map = forget_map_context(agent.proba_map().T, agent.observed_map.T)
-            maps.append(free_map)
+            aggregator.add(free_map)
+            if on_episode is not None:
+                on_episode(start_location, aggregator)
             # self.plot_map(agent.proba_map().T, start_location)
         """
         for _ in xrange(num_cycles):
@@ -54,7 +80,87 @@ class Experiment(object):
         return rewards_received
         """
 
-        merge_maps(maps)
+        if profile_file is not None:
+            with open(profile_file, 'w') as f:
+                json.dump(profiles, f, indent=2)
+        return aggregator.merged
+
+    def run_episodes_lockstep(self, steps_per_episode):
+        """Runs every start position at once, one batched world step per
+        simulation step instead of one environment per episode"""
+        position_coordinates = read_start_positions('robot_start_positions.txt')
+        agents = [self.agent_class(self.spec) for _ in position_coordinates]
+        batched_world = BatchedWallWorld.from_mdp(self.mdp_class(position_coordinates[0]), position_coordinates)
+        observations = batched_world.observations()
+        for _ in xrange(steps_per_episode):
+            destinations = []
+            for agent, observation in zip(agents, observations):
+                observed_bases = {}
+                for direction, distance in zip(batched_world.direction_names, observation[2:]):
+                    observed_bases[agent.direction_bases[direction]] = distance
+                destinations.append(agent.act(tuple(observation[:2]), observed_bases))
+            observations = batched_world.step(destinations)
+
+        maps = [forget_map_context(agent.proba_map().T, agent.observed_map.T) for agent in agents]
+        return merge_maps(maps, max_shape=fused_map_extent(agents[0]))
+
+    def run_episodes_parallel(self, steps_per_episode, processes=None, base_seed=0, stack_file_prefix=None):
+        """Runs one episode per start position in a process pool, yielding
+        (start_location, proba_map, observed_map) as each one finishes.
+        Episode i seeds its agent with base_seed + i, so results don't
+        depend on scheduling. With stack_file_prefix, the maps are also
+        written in start position order to <prefix>_proba.npy and
+        <prefix>_observed.npy, which checkpoint.open_map_stack reopens."""
+        position_coordinates = read_start_positions('robot_start_positions.txt')
+        tasks = [
+            (index, self.agent_class, self.mdp_class, start_location, base_seed + index, steps_per_episode)
+            for index, start_location in enumerate(position_coordinates)
+            ]
+        writers = None
+        pool = Pool(processes)
+        try:
+            for index, start_location, proba_map, observed_map in pool.imap_unordered(run_seeded_episode, tasks):
+                if stack_file_prefix is not None:
+                    if writers is None:
+                        writers = (
+                            MapStackWriter(stack_file_prefix + '_proba.npy', len(tasks), proba_map.shape),
+                            MapStackWriter(stack_file_prefix + '_observed.npy', len(tasks), observed_map.shape),
+                            )
+                    writers[0].write(index, proba_map)
+                    writers[1].write(index, observed_map)
+                yield start_location, proba_map, observed_map
+        finally:
+            pool.terminate()
+            pool.join()
+            if writers is not None:
+                for writer in writers:
+                    writer.close()
+
+    def run_cooperative_episodes(self, steps_per_episode, reduce_interval=0.01, processes=False, base_seed=0, agent_class=SharedMappingAgent):
+        """Runs one robot per start position at the same time, all building
+        one SharedMap, so each robot plans on what the others have seen.
+        Robots run in threads, or in forked processes with processes. Returns
+        the global map in the same NaN-masked form merge_maps produces."""
+        position_coordinates = read_start_positions('robot_start_positions.txt')
+        shared_map = SharedMap(agent_class.BINS_PER_DIMENSION, process_shared=processes)
+        # everything is built before any robot starts, so forked processes
+        # inherit their agent, MDP and shared buffers
+        workers = []
+        for index, start_location in enumerate(position_coordinates):
+            agent = agent_class(self.spec, shared_map, seed=base_seed + index)
+            mdp = self.mdp_class(start_location)
+            worker_class = Process if processes else threading.Thread
+            workers.append(worker_class(target=run_robot, args=(agent, mdp, steps_per_episode)))
+        for worker in workers:
+            worker.start()
+        # started after the fork, so no process inherits a copy of the
+        # reducer thread's state mid-reduce
+        reducer = MapReducer(shared_map, reduce_interval)
+        reducer.start()
+        for worker in workers:
+            worker.join()
+        reducer.stop()
+        return shared_map.masked_proba_map()
 
     def save_policy(self, agent, file_name):
         policy = agent.policy()
@@ -63,26 +169,15 @@ class Experiment(object):
     def save_results(self, output_data, file_name):
         save_dill(output_data, file_name)
 
-    def plot_map(self, to_plot, start_location):
+    def plot_map(self, to_plot, start_location, file_name=None):
+        """Shows the map in a window, or with file_name writes it to a PNG
+        without needing a display"""
+        if file_name is not None:
+            return render_map(to_plot, file_name)
+        # pyplot is only needed for the interactive window
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
-        ax.imshow(to_plot, cmap=cm.gray, interpolation='nearest')
-        numrows, numcols = to_plot.shape
-        def format_coord(x, y):
-            col = int(x)
-            row = int(y)
-            if col >= 0 and col < numcols and row >= 0 and row < numrows:
-                z = to_plot[row, col]
-                return 'x=%1.4f, y=%1.4f, z=%1.4f' % (x, y, z)
-            else:
-                return 'x=%1.4f, y=%1.4f' % (x, y)
-        ax.format_coord = format_coord
-        tick_points = np.arange(-0.5, 49.5, 5.0)
-        labels = map(lambda tick: str(int(tick + 0.5)), tick_points)
-        plt.xticks(tick_points, labels)
-        plt.yticks(tick_points, labels)
-        ax.xaxis.grid(True)
-        ax.yaxis.grid(True)
-        plt.gca().invert_yaxis()
+        draw_map(ax, to_plot)
         # plt.title(start_location)
         plt.show()
 
@@ -90,17 +185,39 @@ class Experiment(object):
 class Episode(object):
     def __init__(self, agent, mdp_class, freeze_exploration, freeze_learning, robot_position):
         self.agent = agent
-        self.environment = Environment(mdp_class(robot_position))
+        self.mdp = mdp_class(robot_position)
+        self.environment = Environment(self.mdp)
         self.freeze_exploration = freeze_exploration
         self.freeze_learning = freeze_learning
+        self.steps_completed = 0
+
+    @classmethod
+    def resume(cls, agent, mdp_class, freeze_exploration, freeze_learning, checkpoint_directory):
+        """Rebuilds an episode from the checkpoint Episode.run last wrote;
+        running it for the original num_steps finishes the remaining ones"""
+        checkpoint = load_checkpoint(checkpoint_directory)
+        restore_agent(agent, checkpoint)
+        episode = cls(agent, mdp_class, freeze_exploration, freeze_learning, checkpoint['robot_position'])
+        episode.steps_completed = checkpoint['steps_completed']
+        return episode
 
-    def run(self, num_steps):
+    def run(self, num_steps, checkpoint_directory=None, checkpoint_interval=100, recorder=None, profiler=None, fast=False):
+        """With fast, the agent and MDP exchange plain arrays through their
+        fast_update methods instead of going through the Environment and
+        the observation/action objects"""
+        if fast:
+            return self.run_fast(num_steps, checkpoint_directory, checkpoint_interval, recorder, profiler)
         freeze_exploration = self.freeze_exploration
         freeze_learning = self.freeze_learning
         agent = self.agent
         environment = self.environment
+        if profiler is None:
+            profiler = NULL_PROFILER
+        else:
+            agent.profiler = profiler
+            self.mdp.set_profiler(profiler)
         state = environment.initial_state()
-        for _ in xrange(num_steps):
+        for step in xrange(self.steps_completed, num_steps):
             observation_map = state.observation_map
             reward = state.reward
 
@@ -112,16 +229,72 @@ class Episode(object):
                 freeze_learning,
                 freeze_exploration,
                 )
-            agent_output = agent.update(new_agent_update)
+            with profiler.timer('agent_update'):
+                agent_output = agent.update(new_agent_update)
+            if recorder is not None:
+                recorder.record_step(step, observation_map, agent_output)
             if termination_signal:
                 break
             new_environment_update = EnvironmentUpdate(
                 agent_output,
                 EpisodeTerminationSignal(False),
                 )
-            state = environment.update_environment(new_environment_update)
+            with profiler.timer('environment_update'):
+                state = environment.update_environment(new_environment_update)
+            profiler.count('steps')
+            self.steps_completed = step + 1
+            if checkpoint_directory is not None and self.steps_completed % checkpoint_interval == 0:
+                save_checkpoint(checkpoint_directory, agent, self.mdp.robot_position(), self.steps_completed)
         return 0
 
+    def run_fast(self, num_steps, checkpoint_directory, checkpoint_interval, recorder, profiler):
+        agent = self.agent
+        mdp = self.mdp
+        if profiler is None:
+            profiler = NULL_PROFILER
+        else:
+            agent.profiler = profiler
+            mdp.set_profiler(profiler)
+        observation = mdp.initial_array()
+        for step in xrange(self.steps_completed, num_steps):
+            with profiler.timer('agent_update'):
+                destination = agent.fast_update(observation)
+            if recorder is not None:
+                recorder.write(step, observation[:2], observation[2:], destination)
+            with profiler.timer('environment_update'):
+                observation = mdp.fast_update(destination)
+            profiler.count('steps')
+            self.steps_completed = step + 1
+            if checkpoint_directory is not None and self.steps_completed % checkpoint_interval == 0:
+                save_checkpoint(checkpoint_directory, agent, mdp.robot_position(), self.steps_completed)
+        return 0
+
+
+def run_seeded_episode(task):
+    index, agent_class, mdp_class, start_location, seed, steps_per_episode = task
+    spec = Environment(mdp_class((1, 1))).spec()
+    agent = agent_class(spec, seed=seed)
+    episode = Episode(agent, mdp_class, FreezeExploration(False), FreezeLearning(False), start_location)
+    episode.run(steps_per_episode)
+    return index, start_location, np.array(agent.proba_map()), agent.observed_map
+
+
+def fused_map_extent(agent):
+    """The agent's whole grid, either way round, since episode maps come
+    back rotated. A fused map bigger than that is misaligned somewhere."""
+    side = max(agent.BINS_PER_DIMENSION)
+    return (side, side)
+
+
+def read_start_positions(file_name):
+    with open(file_name, 'r') as positions:
+        positions_strings = positions.readlines()
+    split_coordinates = [position.split(',') for position in positions_strings]
+    position_coordinates = []
+    for position in split_coordinates:
+        position_coordinates.append([float(coord.strip()) + 1 for coord in position])
+    return position_coordinates
+
 
 def import_from_strings(class_name, module_path):
     # http://stackoverflow.com/a/547867/3737529
@@ -2,51 +2,59 @@ import numpy as np
 from random import Random
 
 
-def forget_map_context(proba_map, observed_map):
-    # has to be revised if not square maps
-    dimension = len(proba_map)
-    for x in xrange(dimension):
-        for y in xrange(dimension):
-            if observed_map[x, y] == 0:
-                proba_map[x, y] = np.NaN
-
-    low_row = find_lowest_row(proba_map, dimension)
-    high_row = find_highest_row(proba_map, dimension)
-    low_col = find_lowest_col(proba_map, dimension)
-    high_col = find_highest_col(proba_map, dimension)
-
-    map_slice = proba_map[low_row:high_row, low_col:high_col]
-    rand = Random()
+def forget_map_context(proba_map, observed_map, rand=None):
+    """Crops the map to the bounding box of its observed cells, with the
+    unobserved cells inside it set to NaN, and applies a random rotation.
+    The caller's proba_map is left untouched."""
+    bounds = observed_bounds(observed_map)
+    if bounds is None:
+        return np.empty((0, 0))
+    rows, cols = bounds
+    map_slice = np.where(observed_map[rows, cols] != 0, proba_map[rows, cols], np.nan)
+    rand = rand or Random()
     rotations = rand.randint(0, 3)
-    rotated = np.rot90(map_slice, rotations)
-
-    return rotated
-
-
-def find_lowest_row(proba_map, dimension):
-    """Can you tell I wrote this at 1:30am?"""
-    for x in xrange(dimension):
-        for y in xrange(dimension):
-            if not np.isnan(proba_map[x, y]):
-                return x
-
-
-def find_lowest_col(proba_map, dimension):
-    for y in xrange(dimension):
-        for x in xrange(dimension):
-            if not np.isnan(proba_map[x, y]):
-                return y
-
-
-def find_highest_row(proba_map, dimension):
-    for x in reversed(xrange(dimension)):
-        for y in xrange(dimension):
-            if not np.isnan(proba_map[x, y]):
-                return x
-
-
-def find_highest_col(proba_map, dimension):
-    for y in reversed(xrange(dimension)):
-        for x in xrange(dimension):
-            if not np.isnan(proba_map[x, y]):
-                return y
+    return np.rot90(map_slice, rotations)
+
+
+def forget_map_context_batch(proba_maps, observed_maps, rand=None):
+    """forget_map_context for a stack of same-shaped maps. The masking and
+    bounding boxes are computed for the whole stack at once; each returned
+    map is a rotated view into one masked copy of the stack."""
+    observed = np.asarray(observed_maps) != 0
+    masked = np.where(observed, proba_maps, np.nan)
+    rows_observed = observed.any(axis=2)
+    cols_observed = observed.any(axis=1)
+    low_rows, high_rows = first_and_last(rows_observed)
+    low_cols, high_cols = first_and_last(cols_observed)
+    rand = rand or Random()
+
+    cropped = []
+    for index in xrange(len(masked)):
+        if not rows_observed[index].any():
+            cropped.append(np.empty((0, 0)))
+            continue
+        map_slice = masked[
+            index,
+            low_rows[index]:high_rows[index] + 1,
+            low_cols[index]:high_cols[index] + 1,
+            ]
+        cropped.append(np.rot90(map_slice, rand.randint(0, 3)))
+    return cropped
+
+
+def observed_bounds(observed_map):
+    """Row and column slices that include every observed cell,
+    or None if nothing was observed"""
+    observed = np.asarray(observed_map) != 0
+    rows = np.flatnonzero(observed.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(observed.any(axis=0))
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+
+def first_and_last(flags):
+    """Index of the first and last True along the last axis of flags"""
+    first = np.argmax(flags, axis=-1)
+    last = flags.shape[-1] - 1 - np.argmax(flags[..., ::-1], axis=-1)
+    return first, last
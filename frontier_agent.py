@@ -0,0 +1,176 @@
+from collections import deque
+from sets import Set
+
+import numpy as np
+
+from mapping_agent import MappingAgent
+
+
+class FrontierSet(object):
+    """Observed free bins with at least one unobserved neighbour. Only the
+    bins a scan touched, and their neighbours, are re-checked after it."""
+    neighbour_offsets = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.is_frontier = np.zeros(self.shape, dtype=bool)
+        # bins scanned from that still border unobserved ones, which the
+        # sensor evidently can't see from there
+        self.retired = np.zeros(self.shape, dtype=bool)
+        self.bins = Set()
+
+    def update(self, log_map, observed_map, xs, ys):
+        xs = np.asarray(xs, dtype=np.intp)
+        ys = np.asarray(ys, dtype=np.intp)
+        candidate_xs = [xs]
+        candidate_ys = [ys]
+        for dx, dy in self.neighbour_offsets:
+            candidate_xs.append(xs + dx)
+            candidate_ys.append(ys + dy)
+        candidate_xs = np.concatenate(candidate_xs)
+        candidate_ys = np.concatenate(candidate_ys)
+        in_bounds = self.in_bounds(candidate_xs, candidate_ys)
+        flat = np.unique(np.ravel_multi_index(
+            (candidate_xs[in_bounds], candidate_ys[in_bounds]),
+            self.shape,
+            ))
+        candidate_xs, candidate_ys = np.unravel_index(flat, self.shape)
+
+        status = self.frontier_status(log_map, observed_map, candidate_xs, candidate_ys)
+        changed = np.flatnonzero(status != self.is_frontier[candidate_xs, candidate_ys])
+        for index in changed:
+            location = (int(candidate_xs[index]), int(candidate_ys[index]))
+            if status[index]:
+                self.bins.add(location)
+            else:
+                self.bins.discard(location)
+        self.is_frontier[candidate_xs, candidate_ys] = status
+
+    def frontier_status(self, log_map, observed_map, xs, ys):
+        status = is_free(log_map, observed_map, xs, ys)
+        next_to_unobserved = np.zeros(len(xs), dtype=bool)
+        for dx, dy in self.neighbour_offsets:
+            neighbour_xs = xs + dx
+            neighbour_ys = ys + dy
+            in_bounds = self.in_bounds(neighbour_xs, neighbour_ys)
+            unobserved = np.zeros(len(xs), dtype=bool)
+            unobserved[in_bounds] = observed_map[neighbour_xs[in_bounds], neighbour_ys[in_bounds]] == 0
+            next_to_unobserved |= unobserved
+        return status & next_to_unobserved & ~self.retired[xs, ys]
+
+    def retire(self, location):
+        self.retired[location] = True
+        self.is_frontier[location] = False
+        self.bins.discard(location)
+
+    def in_bounds(self, xs, ys):
+        return (xs >= 0) & (xs < self.shape[0]) & (ys >= 0) & (ys < self.shape[1])
+
+    def path_to_nearest(self, start, log_map, observed_map):
+        """Breadth-first search through free bins from start to the closest
+        frontier bin. Returns the bins after start up to and including the
+        frontier bin, or an empty list if none can be reached."""
+        if not self.bins:
+            return []
+        previous = {start: None}
+        queue = deque([start])
+        while queue:
+            current = queue.popleft()
+            if current != start and self.is_frontier[current]:
+                path = []
+                while current != start:
+                    path.append(current)
+                    current = previous[current]
+                path.reverse()
+                return path
+            for dx, dy in self.neighbour_offsets:
+                neighbour = (current[0] + dx, current[1] + dy)
+                if neighbour in previous:
+                    continue
+                if not (0 <= neighbour[0] < self.shape[0] and 0 <= neighbour[1] < self.shape[1]):
+                    continue
+                if not (observed_map[neighbour] != 0 and log_map[neighbour] < 0):
+                    continue
+                previous[neighbour] = current
+                queue.append(neighbour)
+        return []
+
+
+def is_free(log_map, observed_map, xs, ys):
+    # proba_from_log_odds is the probability of a bin being free, so free
+    # bins are the ones with negative log odds
+    return (observed_map[xs, ys] != 0) & (log_map[xs, ys] < 0)
+
+
+class FrontierMappingAgent(MappingAgent):
+    """Explores by heading for the nearest frontier instead of wandering.
+    Falls back to MappingAgent's random walk when no frontier is reachable
+    or it stops making progress."""
+    MAX_STALLED_STEPS = 3
+
+    def __init__(self, environment_spec, seed=None):
+        super(FrontierMappingAgent, self).__init__(environment_spec, seed)
+        self.frontier = FrontierSet(self.BINS_PER_DIMENSION)
+        self.path = []
+        self.last_bin = None
+        self.stalled_steps = 0
+
+    def integrate_scan(self, position, directions, distances, log_map, observed_map):
+        log_map, observed_map = super(FrontierMappingAgent, self).integrate_scan(
+            position,
+            directions,
+            distances,
+            log_map,
+            observed_map,
+            )
+        xs, ys = self.last_scan_bins
+        self.frontier.update(log_map, observed_map, xs, ys)
+        return log_map, observed_map
+
+    def restore_maps(self, log_map, observed_map):
+        super(FrontierMappingAgent, self).restore_maps(log_map, observed_map)
+        self.frontier = FrontierSet(self.BINS_PER_DIMENSION)
+        xs, ys = np.nonzero(observed_map)
+        self.frontier.update(log_map, observed_map, xs, ys)
+        self.path = []
+
+    def next_movement(self, position, log_map):
+        current_bin = self.discretize_point(position)
+        if current_bin == self.last_bin:
+            self.stalled_steps += 1
+        else:
+            self.stalled_steps = 0
+        self.last_bin = current_bin
+        if self.frontier.is_frontier[current_bin]:
+            self.frontier.retire(current_bin)
+
+        if self.stalled_steps >= self.MAX_STALLED_STEPS:
+            # the frontier we were heading for can't be reached this way
+            # (usually a wall corner the straight-line waypoint cuts), so
+            # drop it rather than planning the same path again next step
+            if self.path:
+                self.frontier.retire(self.path[-1])
+            self.path = []
+            self.stalled_steps = 0
+            return super(FrontierMappingAgent, self).next_movement(position, log_map)
+
+        if current_bin in self.path:
+            self.path = self.path[self.path.index(current_bin) + 1:]
+        if not self.path or not self.frontier.is_frontier[self.path[-1]]:
+            self.path = self.frontier.path_to_nearest(current_bin, log_map, self.observed_map)
+        if not self.path:
+            return super(FrontierMappingAgent, self).next_movement(position, log_map)
+        return self.waypoint(position)
+
+    def waypoint(self, position):
+        """Centre of the farthest bin along the path within a single move,
+        or a full-length move towards the next bin if none is"""
+        bin_size = np.asarray(self.dimensions, dtype=np.float64) / self.BINS_PER_DIMENSION
+        centres = (np.array(self.path, dtype=np.float64) + 0.5) * bin_size
+        offsets = centres - np.asarray(position, dtype=np.float64)
+        lengths = np.sqrt((offsets ** 2).sum(axis=1))
+        reachable = np.flatnonzero(lengths <= self.MOVEMENT_MAGNITUDE)
+        if len(reachable) > 0:
+            return tuple(centres[reachable[-1]].tolist())
+        step = offsets[0] * (self.MOVEMENT_MAGNITUDE / lengths[0])
+        return tuple((np.asarray(position, dtype=np.float64) + step).tolist())
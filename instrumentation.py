@@ -0,0 +1,69 @@
+import time
+
+
+class Profiler(object):
+    """Named timers and counters for one episode. Components hold a
+    profiler and default to NULL_PROFILER, which does nothing."""
+    enabled = True
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def add_time(self, name, seconds):
+        total, calls = self.timers.get(name, (0.0, 0))
+        self.timers[name] = (total + seconds, calls + 1)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + int(amount)
+
+    def report(self):
+        return {
+            'timers': dict(
+                (name, {'seconds': total, 'calls': calls})
+                for name, (total, calls) in self.timers.items()
+                ),
+            'counters': dict(self.counters),
+            }
+
+
+class Timer(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add_time(self.name, time.time() - self.start)
+        return False
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class NullProfiler(object):
+    enabled = False
+    null_timer = NullTimer()
+
+    def timer(self, name):
+        return self.null_timer
+
+    def count(self, name, amount=1):
+        pass
+
+    def report(self):
+        return {'timers': {}, 'counters': {}}
+
+
+NULL_PROFILER = NullProfiler()
@@ -1,8 +1,6 @@
 import numpy as np
 import math
 import sys
-from random import Random
-from sets import Set
 
 from q_learning_agent import Agent
 from agents import SingleAgentID
@@ -12,6 +10,8 @@ from actions import NumericActionComponent
 from actions import ComponentName
 from observations import FeatureName
 from binning import discretize
+from grid_traversal import traverse_rays
+from instrumentation import NULL_PROFILER
 
 
 class MappingAgent(Agent):
@@ -31,6 +31,9 @@ class MappingAgent(Agent):
         'west': (-1, 0),
         }
 
+    # order of the readings after x and y in a fast_update observation
+    reading_names = ('north', 'east', 'south', 'west')
+
     component_names = {
         'x': ComponentName('x'),
         'y': ComponentName('y'),
@@ -42,7 +45,16 @@ class MappingAgent(Agent):
 
     STARTING_LOG_ODDS_VALUE = 0.0
 
-    def __init__(self, environment_spec):
+    # next_movement gives up and takes its last candidate after this many
+    MAX_MOVEMENT_ATTEMPTS = 102
+
+    MOVEMENT_BATCH_SIZE = 16
+
+    # sample straight from the normalised probabilities around the robot
+    # instead of rejection sampling
+    SAMPLE_FROM_WINDOW = False
+
+    def __init__(self, environment_spec, seed=None):
         action_descriptors = environment_spec.action_descriptors
         self.x_component_descriptor = action_descriptors.descriptors[self.component_names['x']]
         self.y_component_descriptor = action_descriptors.descriptors[self.component_names['y']]
@@ -53,13 +65,33 @@ class MappingAgent(Agent):
             )
 
         self.agent_id = SingleAgentID()
-        x_bins = self.BINS_PER_DIMENSION[0]
-        y_bins = self.BINS_PER_DIMENSION[1]
-        self.log_map = np.zeros((x_bins, y_bins)) + self.STARTING_LOG_ODDS_VALUE
-        self.observed_map = np.zeros((x_bins, y_bins))
-        self.rand = Random()
+        self.BINS_PER_DIMENSION = self.bins_for(self.dimensions)
+        self.log_map = self.new_map(self.STARTING_LOG_ODDS_VALUE)
+        self.observed_map = self.new_map(0)
+        self.proba_cache = self.new_map(self.proba_from_log_odds(self.STARTING_LOG_ODDS_VALUE))
+        self.profiler = NULL_PROFILER
+        self.reading_directions = np.array(
+            [self.direction_bases[name] for name in self.reading_names],
+            dtype=np.float64,
+            )
+        # bins whose cached probability is out of date, as (xs, ys) batches,
+        # and how many bins that is in all
+        self.stale_bins = []
+        self.stale_count = 0
+        self.proba_cache_source = None
+        self.np_rand = np.random.RandomState(seed)
+        self.free_log_odds = self.inverse_sensor(None, False) - self.STARTING_LOG_ODDS_VALUE
+        self.occupied_log_odds = self.inverse_sensor(None, True) - self.STARTING_LOG_ODDS_VALUE
         # self.updates = 0
 
+    def bins_for(self, dimensions):
+        return self.BINS_PER_DIMENSION
+
+    def new_map(self, fill_value):
+        new_map = np.empty(self.BINS_PER_DIMENSION)
+        new_map.fill(fill_value)
+        return new_map
+
     def update(self, agent_update):
         observation_map = agent_update.observation_map
         observation = observation_map.observations[self.agent_id]
@@ -79,16 +111,9 @@ class MappingAgent(Agent):
             self.updates += 1
             """
 
-        self.log_map, self.observed_map = self.update_maps(
-            self.position,
-            self.log_map,
-            self.observed_map,
-            observed_bases,
-            )
-
         action_map = ActionMap()
         action = Action()
-        next_x, next_y = self.next_movement(self.position, self.log_map)
+        next_x, next_y = self.act(self.position, observed_bases)
         x_component = NumericActionComponent(next_x)
         action.add_component(self.component_names['x'], x_component)
         y_component = NumericActionComponent(next_y)
@@ -96,68 +121,142 @@ class MappingAgent(Agent):
         action_map.add_action(self.agent_id, action)
         return action_map
 
-    def next_movement(self, position, log_map, attempts=0):
-        lower_mag, upper_mag = -1 * self.MOVEMENT_MAGNITUDE, self.MOVEMENT_MAGNITUDE
-        candidate = (
-            position[0] + self.rand.uniform(lower_mag, upper_mag),
-            position[1] + self.rand.uniform(lower_mag, upper_mag),
-            )
-        disc_candidate = self.discretize_point(candidate)
-        log_odds = log_map[disc_candidate[0], disc_candidate[1]]
-        proba = self.proba_from_log_odds(log_odds)
-        if self.rand.uniform(0, 1) < proba or attempts > 100:
-            return candidate
-        else:
-            return self.next_movement(position, log_map, attempts + 1)
+    def act(self, position, observed_bases):
+        """Integrates one set of readings and returns the next destination,
+        without going through the observation/action objects"""
+        self.position = position
+        with self.profiler.timer('map_update'):
+            self.log_map, self.observed_map = self.update_maps(
+                self.position,
+                self.log_map,
+                self.observed_map,
+                observed_bases,
+                )
+        with self.profiler.timer('next_movement'):
+            return self.next_movement(self.position, self.log_map)
 
-    def update_maps(self, position, log_map, observed_map, observed_bases):
-        position_in_grid = self.discretize_point(position)
-        for basis, distance in zip(observed_bases.keys(), observed_bases.values()):
-            theta_from_horizontal = self.angle_between(basis, (1, 0))
-            endpoint = (
-                position[0] + distance * math.cos(theta_from_horizontal),
-                position[1] + distance * math.sin(theta_from_horizontal),
+    def fast_update(self, observation):
+        """update without the message objects: takes an array of x, y and
+        the reading_names distances and returns the next (x, y)"""
+        self.position = (float(observation[0]), float(observation[1]))
+        with self.profiler.timer('map_update'):
+            self.log_map, self.observed_map = self.integrate_scan(
+                self.position,
+                self.reading_directions,
+                np.asarray(observation[2:], dtype=np.float64),
+                self.log_map,
+                self.observed_map,
+                )
+        with self.profiler.timer('next_movement'):
+            return self.next_movement(self.position, self.log_map)
+
+    def next_movement(self, position, log_map):
+        """Rejection-samples a destination within MOVEMENT_MAGNITUDE of
+        position, accepting a candidate with the probability of its bin.
+        Candidates are drawn and looked up in batches; after
+        MAX_MOVEMENT_ATTEMPTS rejections the last candidate is used."""
+        if self.SAMPLE_FROM_WINDOW:
+            return self.window_movement(position, log_map)
+        attempts = 0
+        while True:
+            batch_size = min(self.MOVEMENT_BATCH_SIZE, self.MAX_MOVEMENT_ATTEMPTS - attempts)
+            draws = self.np_rand.uniform(size=(batch_size, 3))
+            candidates = np.asarray(position, dtype=np.float64) + (
+                (2 * draws[:, :2] - 1) * self.MOVEMENT_MAGNITUDE
                 )
-            endpoint_in_grid = self.discretize_point(endpoint)
-            bins_crossed = self.bins_crossed(position_in_grid, endpoint_in_grid)
-
-            for bin_location in bins_crossed:
-                log_map, observed_map = self.update_bin(
-                    bin_location,
-                    log_map,
-                    observed_map,
-                    False,
-                    )
-            log_map, observed_map = self.update_bin(
-                endpoint_in_grid,
+            proba = self.bin_probabilities(
                 log_map,
-                observed_map,
-                True,
+                self.discretize_in_direction(candidates[:, 0], 0),
+                self.discretize_in_direction(candidates[:, 1], 1),
                 )
-        return log_map, observed_map
+            accepted = np.flatnonzero(draws[:, 2] < proba)
+            if len(accepted) > 0:
+                self.profiler.count('sampling_attempts', attempts + accepted[0] + 1)
+                return tuple(candidates[accepted[0]].tolist())
+            attempts += batch_size
+            if attempts >= self.MAX_MOVEMENT_ATTEMPTS:
+                self.profiler.count('sampling_attempts', attempts)
+                return tuple(candidates[-1].tolist())
 
-    def update_bin(self, bin_location, log_map, observed_map, obstacle_encountered):
-        x = bin_location[0]
-        y = bin_location[1]
+    def window_movement(self, position, log_map):
+        """Samples a bin within MOVEMENT_MAGNITUDE of position in proportion
+        to its probability, then a uniform point inside it"""
+        lower = np.asarray(position, dtype=np.float64) - self.MOVEMENT_MAGNITUDE
+        upper = np.asarray(position, dtype=np.float64) + self.MOVEMENT_MAGNITUDE
+        low_bins = self.discretize_point(lower)
+        high_bins = self.discretize_point(upper)
+        xs, ys = np.meshgrid(
+            np.arange(low_bins[0], high_bins[0] + 1),
+            np.arange(low_bins[1], high_bins[1] + 1),
+            indexing='ij',
+            )
+        xs, ys = xs.ravel(), ys.ravel()
+        weights = self.bin_probabilities(log_map, xs, ys)
+        if weights.sum() > 0:
+            chosen = self.np_rand.choice(len(weights), p=weights / weights.sum())
+        else:
+            chosen = self.np_rand.randint(len(weights))
 
-        observed_map[x, y] = 1
-        """
-        print "bin loc: " + str(bin_location)
-        print "position: " + str(self.position)
-        print "before: " + str(log_map[x, y])
-        print "obstacle encountered: " + str(obstacle_encountered)
-        """
-        log_map[x, y] = log_map[x, y] + self.inverse_sensor(
-            bin_location,
-            obstacle_encountered,
-            ) - self.STARTING_LOG_ODDS_VALUE
-        # print "after: " + str(log_map[x, y])
-        """
-        if self.rand.uniform(0, 1) < 0.05:
-            sys.exit()
-            """
+        bin_size = np.asarray(self.dimensions, dtype=np.float64) / self.BINS_PER_DIMENSION
+        bin_lower = np.maximum(np.array([xs[chosen], ys[chosen]]) * bin_size, lower)
+        bin_upper = np.minimum(np.array([xs[chosen] + 1, ys[chosen] + 1]) * bin_size, upper)
+        return tuple(self.np_rand.uniform(bin_lower, np.maximum(bin_lower, bin_upper)).tolist())
+
+    def bin_probabilities(self, log_map, xs, ys):
+        if log_map is self.log_map:
+            return self.proba_map()[xs, ys]
+        return 1 / (1 + np.exp(log_map[xs, ys]))
+
+    def update_maps(self, position, log_map, observed_map, observed_bases):
+        bases, distances = zip(*observed_bases.items())
+        return self.integrate_scan(
+            position,
+            np.array(bases, dtype=np.float64),
+            np.array(distances, dtype=np.float64),
+            log_map,
+            observed_map,
+            )
+
+    def integrate_scan(self, position, directions, distances, log_map, observed_map):
+        """Applies a whole scan in one go: directions is an (N, 2) array of
+        unit vectors and distances the range read along each of them, and
+        position is either one point or an (N, 2) array of beam origins. Every
+        bin a beam crosses gets the free update and every bin a beam ends
+        in gets the occupied update, all through a single np.add.at."""
+        origins = np.empty((len(distances), 2))
+        origins[:] = position
+        endpoints = origins + directions * distances[:, None]
+        free_xs, free_ys, _ = self.cells_crossed(origins, endpoints)
+        hits = self.discretize_points(endpoints)
+
+        xs = np.concatenate((free_xs, hits[:, 0]))
+        ys = np.concatenate((free_ys, hits[:, 1]))
+        changes = np.empty(len(xs))
+        changes[:len(free_xs)] = self.free_log_odds
+        changes[len(free_xs):] = self.occupied_log_odds
+        self.accumulate(log_map, xs, ys, changes)
+        self.profiler.count('bins_updated', len(xs))
+        observed_map[xs, ys] = 1
+        self.mark_stale(xs, ys)
+        self.last_scan_bins = (xs, ys)
         return log_map, observed_map
-        
+
+    def mark_stale(self, xs, ys):
+        """Queues bins for proba_map to refresh. Callers that go thousands
+        of steps without reading the map would grow the queue forever, so
+        past a grid's worth of bins it is dropped for one full refresh."""
+        if self.proba_cache_source is None:
+            # a full refresh is due anyway
+            return
+        self.stale_count += len(xs)
+        if self.stale_count > self.log_map.size:
+            self.invalidate_proba_map()
+        else:
+            self.stale_bins.append((xs, ys))
+
+    def accumulate(self, log_map, xs, ys, changes):
+        np.add.at(log_map, (xs, ys), changes)
+
     def inverse_sensor(self, bin_location, obstacle_encountered):
         if obstacle_encountered:
             proba = 0.8
@@ -166,39 +265,16 @@ class MappingAgent(Agent):
 
         return math.log(proba / (1 - proba))
 
-    def bins_crossed(self, position_in_grid, endpoint_in_grid):
-        """
-        IF I WANT DIAGONAL SENSES
-        I HAVE TO SIGNIFICANTLY IMPROVE THIS            
-        Does not include endpoint in return set"""
-        bins_crossed = Set()
-        if position_in_grid[0] == endpoint_in_grid[0]:
-            # movement is in y direction
-            for y_coord in self.get_range(
-                position_in_grid[1],
-                endpoint_in_grid[1],
-                ):
-                    bins_crossed.add((position_in_grid[0], y_coord))
-        elif position_in_grid[1] == endpoint_in_grid[1]:
-            # movement is in x direction
-            for x_coord in self.get_range(
-                position_in_grid[0],
-                endpoint_in_grid[0],
-                ):
-                    bins_crossed.add((x_coord, position_in_grid[1]))
-
-        else:
-            raise ValueError("Diagonal movement")
-
-        return bins_crossed
-
-    def get_range(self, pos_coord, end_coord):
-        if pos_coord == end_coord:
-            return []
-        elif pos_coord < end_coord:
-            return xrange(pos_coord, end_coord)
-        else:
-            return xrange(end_coord + 1, pos_coord + 1)
+    def cells_crossed(self, origins, endpoints):
+        """Bins crossed by many rays between points in world coordinates, as
+        (xs, ys, rays) index arrays, where rays says which ray each bin
+        belongs to. Endpoint bins are not included."""
+        scale = np.array(self.BINS_PER_DIMENSION, dtype=np.float64) / self.dimensions
+        return traverse_rays(
+            np.asarray(origins, dtype=np.float64) * scale,
+            np.asarray(endpoints, dtype=np.float64) * scale,
+            self.BINS_PER_DIMENSION,
+            )
 
     def proba_from_log_odds(self, log_odds):
         """This should be 1 - (thing I'm returning) but that's producing
@@ -212,6 +288,12 @@ class MappingAgent(Agent):
             self.discretize_in_direction(point[1], 1),
             )
             
+    def discretize_points(self, points):
+        """discretize_point for an (N, 2) array, in one go"""
+        bins = np.array(self.BINS_PER_DIMENSION)
+        scaled = bins * (points / np.array(self.dimensions, dtype=np.float64))
+        return np.minimum(np.maximum(scaled.astype(int), 0), bins - 1)
+
     def discretize_in_direction(self, val, direction):
         return discretize(
             val,
@@ -220,8 +302,39 @@ class MappingAgent(Agent):
             self.BINS_PER_DIMENSION[direction],
             )
 
-    def angle_between(self, vec1, vec2):
-        return math.acos(np.dot(vec1, vec2) / (math.sqrt(vec1[0] ** 2 + vec1[1] ** 2) * math.sqrt(vec2[0] ** 2 + vec2[1] ** 2)))
-
     def proba_map(self):
-        return np.array([map(self.proba_from_log_odds, row) for row in self.log_map])
+        """Read-only probability view of log_map. Only the bins updated
+        since the last call are recomputed; call invalidate_proba_map after
+        writing to log_map some other way.
+
+        The view is of a cache the agent keeps updating, so it is only
+        good until the next scan; copy anything you keep."""
+        if self.proba_cache_source is not self.log_map:
+            self.invalidate_proba_map()
+        if self.proba_cache_source is None:
+            self.proba_cache[:] = 1 / (1 + np.exp(self.log_map))
+            self.proba_cache_source = self.log_map
+        elif self.stale_bins:
+            xs = np.concatenate([np.asarray(bins[0], dtype=np.intp) for bins in self.stale_bins])
+            ys = np.concatenate([np.asarray(bins[1], dtype=np.intp) for bins in self.stale_bins])
+            self.proba_cache[xs, ys] = 1 / (1 + np.exp(self.log_map[xs, ys]))
+        self.stale_bins = []
+        self.stale_count = 0
+        view = self.proba_cache.view()
+        view.flags.writeable = False
+        return view
+
+    def restore_maps(self, log_map, observed_map):
+        """Swaps in previously saved maps, e.g. from a checkpoint"""
+        self.log_map = log_map
+        self.observed_map = observed_map
+        self.invalidate_proba_map()
+
+    def coverage(self):
+        """Fraction of bins observed so far"""
+        return np.count_nonzero(self.observed_map) / float(self.observed_map.size)
+
+    def invalidate_proba_map(self):
+        self.proba_cache_source = None
+        self.stale_bins = []
+        self.stale_count = 0
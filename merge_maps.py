@@ -1,8 +1,238 @@
 import numpy as np
 
 
-def merge_maps(maps):
-    print similarity_score(maps[1], maps[2])
+# an alignment has to overlap at least this share of the smaller map's
+# observed cells, otherwise a few perfectly matching cells win
+MIN_OVERLAP_FRACTION = 0.3
+
+# align_maps scores below this are more often wrong than right
+MIN_ALIGNMENT_SCORE = 0.35
+
+# per-cell variance under which an overlap counts as featureless
+FLAT_VARIANCE = 1e-6
+
+# keeps fully certain cells from turning into infinite log odds
+PROBA_CLIP = 1e-6
+
+
+def merge_maps(maps, max_shape=None):
+    """Fuses NaN-masked partial maps (unobserved cells are NaN) into one
+    global map, aligning each map to what has been merged so far"""
+    aggregator = MapAggregator(track_similarity=False, max_shape=max_shape)
+    for partial_map in maps:
+        aggregator.add(partial_map)
+    return aggregator.merged
+
+
+class MapAggregator(object):
+    """Folds partial maps into a fused map one at a time, as merge_maps
+    does, along with running statistics, so a sweep only ever holds the
+    fused map and the previous partial map however many episodes it runs.
+    Maps that don't align with the fused map well enough (see align_maps)
+    are counted as rejected instead of being fused. With max_shape, the
+    fused map is cropped to at most that many rows and columns after each
+    fold, keeping the window with the most observed cells, so it can't
+    outgrow the world however many episodes go in.
+
+    Tracks, with Welford's running mean and variance:
+        similarity  similarity_score between consecutive partial maps
+        coverage    fraction of each partial map that was observed, over
+                    the maps that observed anything"""
+    def __init__(self, track_similarity=True, max_shape=None):
+        self.track_similarity = track_similarity
+        self.max_shape = max_shape
+        self.merged = None
+        self.previous = None
+        self.count = 0
+        self.rejected = 0
+        self.similarity = RunningStats()
+        self.coverage = RunningStats()
+
+    def add(self, partial_map):
+        if partial_map.size == 0:
+            pass
+        elif self.merged is None:
+            self.merged = self.cropped(partial_map)
+        else:
+            rotations, offset, score = align_maps(self.merged, partial_map)
+            if score < MIN_ALIGNMENT_SCORE:
+                self.rejected += 1
+            else:
+                self.merged = self.cropped(fuse_maps(self.merged, np.rot90(partial_map, rotations), offset))
+        if self.track_similarity:
+            if self.previous is not None:
+                self.similarity.add(similarity_score(self.previous, partial_map))
+            self.previous = partial_map
+        # an episode that observed nothing comes back as a (0, 0) map,
+        # which has no coverage to speak of rather than a 0/0 one
+        if partial_map.size:
+            self.coverage.add(np.count_nonzero(~np.isnan(partial_map)) / float(partial_map.size))
+        self.count += 1
+        return self
+
+    def cropped(self, fused):
+        if self.max_shape is None:
+            return fused
+        return densest_window(fused, self.max_shape)
+
+    def merged_coverage(self):
+        """Fraction of the fused map's cells that some map observed"""
+        if self.merged is None:
+            return 0.0
+        return float(np.count_nonzero(~np.isnan(self.merged))) / self.merged.size
+
+    def summary(self):
+        return {
+            'maps': self.count,
+            'rejected': self.rejected,
+            'merged_shape': None if self.merged is None else list(self.merged.shape),
+            'merged_coverage': self.merged_coverage(),
+            'similarity': self.similarity.summary(),
+            'coverage': self.coverage.summary(),
+            }
+
+
+class RunningStats(object):
+    """Welford's running mean and variance"""
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.sum_of_squares = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        value = float(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.sum_of_squares += delta * (value - self.mean)
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.sum_of_squares / (self.count - 1)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'std': self.variance() ** 0.5,
+            'min': self.minimum,
+            'max': self.maximum,
+            }
+
+
+def align_maps(reference, moving):
+    """Finds the rotation (number of np.rot90 quarter turns) and offset of
+    moving's origin inside reference's frame that best line the maps up,
+    and how well they do: the normalised cross-correlation over the cells
+    both maps observed, scaled by the square root of the share of the
+    smaller map that overlap covers. 1 is a perfect match of the whole
+    smaller map, featureless overlaps score 0 and ones below
+    MIN_OVERLAP_FRACTION -inf; a match below MIN_ALIGNMENT_SCORE is better
+    not fused. Every offset of each rotation is scored at once with FFT
+    cross-correlations."""
+    smaller = min(np.count_nonzero(~np.isnan(reference)), np.count_nonzero(~np.isnan(moving)))
+    best = None
+    for rotations in xrange(4):
+        rotated = np.rot90(moving, rotations)
+        correlation, overlap = masked_correlation(reference, rotated)
+        share = overlap / float(max(smaller, 1))
+        scores = np.where(share >= MIN_OVERLAP_FRACTION, correlation * np.sqrt(share), -np.inf)
+        index = np.unravel_index(np.argmax(scores), scores.shape)
+        if best is None or scores[index] > best[2]:
+            offset = tuple(
+                int(i) if i < reference.shape[axis] else int(i) - scores.shape[axis]
+                for axis, i in enumerate(index)
+                )
+            best = (rotations, offset, float(scores[index]))
+    return best
+
+
+def masked_correlation(reference, moving):
+    """Pearson correlation and overlap count of the observed cells for
+    every offset of moving relative to reference, 0 where either side of
+    the overlap is flat. Negative offsets wrap around to the end of the
+    returned arrays."""
+    shape = (
+        reference.shape[0] + moving.shape[0] - 1,
+        reference.shape[1] + moving.shape[1] - 1,
+        )
+    reference_mask = (~np.isnan(reference)).astype(np.float64)
+    reference_values = np.nan_to_num(reference)
+    moving_mask = (~np.isnan(moving)).astype(np.float64)
+    moving_values = np.nan_to_num(moving)
+
+    reference_terms = [np.fft.rfft2(f, shape) for f in (reference_mask, reference_values, reference_values ** 2)]
+    moving_terms = [np.conj(np.fft.rfft2(g, shape)) for g in (moving_mask, moving_values, moving_values ** 2)]
+
+    def correlate(i, j):
+        return np.fft.irfft2(reference_terms[i] * moving_terms[j], shape)
+
+    overlap = np.rint(correlate(0, 0))
+    count = np.maximum(overlap, 1)
+    reference_sum = correlate(1, 0)
+    moving_sum = correlate(0, 1)
+    covariance = correlate(1, 1) - reference_sum * moving_sum / count
+    reference_variance = correlate(2, 0) - reference_sum ** 2 / count
+    moving_variance = correlate(0, 2) - moving_sum ** 2 / count
+    # FFT round-off leaves flat overlaps with tiny, noisy variances
+    flat = (reference_variance <= FLAT_VARIANCE * count) | (moving_variance <= FLAT_VARIANCE * count)
+    correlation = covariance / np.sqrt(np.where(flat, 1, reference_variance * moving_variance))
+    correlation[flat | (overlap < 2)] = 0
+    return correlation, overlap
+
+
+def fuse_maps(reference, moving, offset):
+    """Adds the two maps in log-odds space on a canvas covering both, with
+    moving's origin at offset in reference's frame. Cells neither map
+    observed stay NaN."""
+    top = min(0, offset[0])
+    left = min(0, offset[1])
+    bottom = max(reference.shape[0], offset[0] + moving.shape[0])
+    right = max(reference.shape[1], offset[1] + moving.shape[1])
+    log_odds = np.zeros((bottom - top, right - left))
+    observed = np.zeros(log_odds.shape, dtype=bool)
+    for partial_map, (row, col) in ((reference, (0, 0)), (moving, offset)):
+        window = (
+            slice(row - top, row - top + partial_map.shape[0]),
+            slice(col - left, col - left + partial_map.shape[1]),
+            )
+        partial_observed = ~np.isnan(partial_map)
+        log_odds[window] += np.where(partial_observed, log_odds_from_proba(partial_map), 0)
+        observed[window] |= partial_observed
+    return np.where(observed, proba_from_log_odds(log_odds), np.nan)
+
+
+def densest_window(partial_map, max_shape):
+    """The window of at most max_shape holding the most observed cells,
+    found with a summed-area table"""
+    rows = min(partial_map.shape[0], max_shape[0])
+    cols = min(partial_map.shape[1], max_shape[1])
+    if (rows, cols) == partial_map.shape:
+        return partial_map
+    table = np.zeros((partial_map.shape[0] + 1, partial_map.shape[1] + 1))
+    table[1:, 1:] = np.cumsum(np.cumsum(~np.isnan(partial_map), axis=0), axis=1)
+    last_row = partial_map.shape[0] - rows + 1
+    last_col = partial_map.shape[1] - cols + 1
+    counts = (
+        table[rows:, cols:] - table[:last_row, cols:] -
+        table[rows:, :last_col] + table[:last_row, :last_col]
+        )
+    row, col = np.unravel_index(np.argmax(counts), counts.shape)
+    return partial_map[row:row + rows, col:col + cols]
+
+
+def log_odds_from_proba(proba):
+    proba = np.clip(proba, PROBA_CLIP, 1 - PROBA_CLIP)
+    return np.log(proba / (1 - proba))
+
+
+def proba_from_log_odds(log_odds):
+    return 1 / (1 + np.exp(-log_odds))
 
 
 def similarity_score(map1, map2):
@@ -11,35 +241,59 @@ def similarity_score(map1, map2):
     f2 = map2.flatten()
     u2 = np.unique(f2[~np.isnan(f2)])
     c_values = np.unique(np.concatenate((u1, u2)))
+    # both maps share an origin, so one frame covering both holds every pair
+    frame = (max(map1.shape[0], map2.shape[0]), max(map1.shape[1], map2.shape[1]))
     accum = 0
     for value in c_values:
-        accum += distance(map1, map2, value) + distance(map2, map1, value)
+        accum += distance(map1, map2, value, frame) + distance(map2, map1, value, frame)
     return accum
 
 
-def distance(map1, map2, value):
-    if not np.isnan(value):
-        accum = []
-        for x1 in xrange(map1.shape[0]):
-            for y1 in xrange(map1.shape[1]):
-                if map1[x1, y1] == value:
-                    matching = []
-                    for x2 in xrange(map2.shape[0]):
-                        for y2 in xrange(map2.shape[1]):
-                            if map2[x2, y2] == value:
-                                matching.append(
-                                    manhattan_distance((x1, y1), (x2, y2))
-                                    )
-                    if len(matching) > 0:
-                        accum.append(min(matching))
-                    else:
-                        accum.append(0)
-        if len(accum) == 0:
-            return 0
-        else:
-            return sum(accum) / len(accum)
-    else:
+def distance(map1, map2, value, frame=None):
+    """Average over the cells of map1 holding value of the Manhattan distance
+    to the closest cell of map2 holding value (0 when map2 has none),
+    floored like the integer average it has always been"""
+    if np.isnan(value):
+        return 0
+    sources = map1 == value
+    source_count = np.count_nonzero(sources)
+    targets = map2 == value
+    if source_count == 0 or not targets.any():
         return 0
+    if frame is None:
+        frame = (max(map1.shape[0], map2.shape[0]), max(map1.shape[1], map2.shape[1]))
+    field = manhattan_distance_transform(targets, frame)
+    total = field[:map1.shape[0], :map1.shape[1]][sources].sum()
+    return int(total) // source_count
+
+
+def manhattan_distance_transform(mask, frame):
+    """Taxicab distance from every cell of a frame-shaped grid to the closest
+    True cell of mask, which sits at the grid's origin. The distance is
+    separable, so one pass per axis in each direction is exact."""
+    unreachable = 2 * (frame[0] + frame[1])
+    field = np.empty(frame, dtype=np.int64)
+    field.fill(unreachable)
+    field[:mask.shape[0], :mask.shape[1]][mask] = 0
+    for axis in (1, 0):
+        field = manhattan_sweep(field, axis)
+    return field
+
+
+def manhattan_sweep(field, axis):
+    # min over j of field[j] + |i - j|, split into j <= i and j >= i and
+    # turned into running minimums of field[j] -/+ j
+    index = np.arange(field.shape[axis])
+    if axis == 1:
+        index = index[None, :]
+    else:
+        index = index[:, None]
+    forward = np.minimum.accumulate(field - index, axis=axis) + index
+    reverse = [slice(None), slice(None)]
+    reverse[axis] = slice(None, None, -1)
+    reverse = tuple(reverse)
+    backward = np.minimum.accumulate((field + index)[reverse], axis=axis)[reverse] - index
+    return np.minimum(forward, backward)
 
 
 def manhattan_distance(point1, point2):
@@ -1,8 +1,8 @@
-import pylab as pl
-from matplotlib import collections as mc
-
-
-def plot_real_map(walls_list_file):
+def plot_real_map(walls_list_file, file_name=None):
+    """Draws the walls from walls_list_file plus the border in a window, or
+    with file_name writes them to a PNG without needing a display"""
+    # matplotlib is imported here so importing this module stays cheap
+    from matplotlib import collections as mc
     with open(walls_list_file, 'r') as f:
         walls_list = f.readlines()
     split_coordinates = [wall.split(',') for wall in walls_list]
@@ -18,7 +18,16 @@ def plot_real_map(walls_list_file):
         walls.append([(coord[0], coord[1]), (coord[2], coord[3])])
 
     lc = mc.LineCollection(walls, linewidths=2)
-    fig, ax = pl.subplots()
+    if file_name is not None:
+        from rendering import new_figure
+        fig = new_figure()
+        ax = fig.add_subplot(1, 1, 1)
+    else:
+        import pylab as pl
+        fig, ax = pl.subplots()
     ax.add_collection(lc)
     ax.margins(0.1)
-    fig.show()
+    if file_name is not None:
+        fig.savefig(file_name)
+    else:
+        fig.show()
@@ -0,0 +1,109 @@
+"""Off-screen map rendering for headless runs.
+
+Everything here draws on an Agg canvas directly, without pyplot, so it
+works without a display and never blocks. matplotlib is only imported
+when something is actually drawn, so importing this module is cheap.
+
+    render_maps(maps, ['map_%d.png' % i for i in xrange(len(maps))])
+    contact_sheet(maps, 'sweep.png', titles=start_locations)"""
+from multiprocessing import Pool
+
+import numpy as np
+
+
+def draw_map(ax, to_plot, title=None):
+    """Draws a probability map the way Experiment.plot_map always has:
+    grey, origin at the bottom left, grid lines every 5 bins"""
+    from matplotlib import cm
+    ax.imshow(to_plot, cmap=cm.gray, interpolation='nearest')
+    numrows, numcols = to_plot.shape
+    def format_coord(x, y):
+        col = int(x)
+        row = int(y)
+        if col >= 0 and col < numcols and row >= 0 and row < numrows:
+            z = to_plot[row, col]
+            return 'x=%1.4f, y=%1.4f, z=%1.4f' % (x, y, z)
+        else:
+            return 'x=%1.4f, y=%1.4f' % (x, y)
+    ax.format_coord = format_coord
+    tick_points = np.arange(-0.5, 49.5, 5.0)
+    labels = [str(int(tick + 0.5)) for tick in tick_points]
+    ax.set_xticks(tick_points)
+    ax.set_xticklabels(labels)
+    ax.set_yticks(tick_points)
+    ax.set_yticklabels(labels)
+    ax.xaxis.grid(True)
+    ax.yaxis.grid(True)
+    ax.invert_yaxis()
+    if title is not None:
+        ax.set_title(str(title))
+
+
+def new_figure(size=(6, 6), dpi=100):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figure = Figure(figsize=size, dpi=dpi)
+    FigureCanvasAgg(figure)
+    return figure
+
+
+def render_map(to_plot, file_name, title=None, dpi=100):
+    """Writes one map to a PNG"""
+    figure = new_figure(dpi=dpi)
+    draw_map(figure.add_subplot(1, 1, 1), to_plot, title)
+    figure.savefig(file_name)
+    return file_name
+
+
+def render_map_pixels(to_plot, title=None, dpi=100):
+    """One map drawn to an (height, width, 4) uint8 RGBA array"""
+    figure = new_figure(dpi=dpi)
+    draw_map(figure.add_subplot(1, 1, 1), to_plot, title)
+    figure.canvas.draw()
+    # older matplotlib hands back a flat buffer, so shape it ourselves
+    width, height = figure.canvas.get_width_height()
+    return np.frombuffer(figure.canvas.buffer_rgba(), np.uint8).reshape(height, width, 4).copy()
+
+
+def render_task(task):
+    to_plot, file_name, title, dpi = task
+    if file_name is None:
+        return render_map_pixels(to_plot, title, dpi)
+    return render_map(to_plot, file_name, title, dpi)
+
+
+def render_all(maps, file_names, titles, dpi, processes):
+    if titles is None:
+        titles = [None] * len(maps)
+    tasks = [(to_plot, file_name, title, dpi) for to_plot, file_name, title in zip(maps, file_names, titles)]
+    if processes == 1 or len(tasks) < 2:
+        return [render_task(task) for task in tasks]
+    pool = Pool(processes)
+    try:
+        return pool.map(render_task, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def render_maps(maps, file_names, titles=None, dpi=100, processes=None):
+    """Writes each map to its own PNG, spread over a process pool"""
+    return render_all(maps, file_names, titles, dpi, processes)
+
+
+def contact_sheet(maps, file_name, titles=None, columns=None, dpi=50, processes=None):
+    """Draws every map in a pool of workers and tiles the pictures into
+    one PNG, columns wide (about square by default)"""
+    tiles = render_all(maps, [None] * len(maps), titles, dpi, processes)
+    if columns is None:
+        columns = int(np.ceil(np.sqrt(len(tiles))))
+    rows = int(np.ceil(len(tiles) / float(columns)))
+    height, width = tiles[0].shape[:2]
+    sheet = np.empty((rows * height, columns * width, 4), dtype=np.uint8)
+    sheet.fill(255)
+    for index, tile in enumerate(tiles):
+        row, col = divmod(index, columns)
+        sheet[row * height:(row + 1) * height, col * width:(col + 1) * width] = tile
+    from matplotlib import image
+    image.imsave(file_name, sheet)
+    return file_name
@@ -0,0 +1,196 @@
+"""Cooperative mapping: several MappingAgents build one global log-odds map
+instead of one private map each.
+
+Agents never write to the global map. Each one adds its scans into its
+own DeltaBuffer, and a single reducer (SharedMap.reduce, usually run by a
+MapReducer thread every few milliseconds) folds the buffers into the
+global map. Handing a buffer over only involves two counters per agent,
+each written by one side, so there are no locks:
+
+    writer_seq  bumped by the agent when it hands over the buffer it has
+                been filling and switches to the other one
+    reducer_seq bumped by the reducer once it has folded and zeroed the
+                handed-over buffer
+
+The agent only hands over when writer_seq == reducer_seq, i.e. when the
+other buffer is empty again; until then it keeps adding into the one it
+has, which is harmless because deltas add up.
+
+With process_shared, every array and counter lives in multiprocessing
+shared memory, so agents in forked processes can take part as long as
+they are registered before the fork."""
+import threading
+from multiprocessing.sharedctypes import RawArray
+from multiprocessing.sharedctypes import RawValue
+
+import numpy as np
+
+from mapping_agent import MappingAgent
+
+
+def new_array(shape, process_shared):
+    if not process_shared:
+        return np.zeros(shape)
+    size = int(np.prod(shape))
+    return np.frombuffer(RawArray('d', size), dtype=np.float64).reshape(shape)
+
+
+class DeltaBuffer(object):
+    """Double-buffered log-odds deltas and observed flags for one agent"""
+    def __init__(self, shape, process_shared=False):
+        self.log_deltas = (new_array(shape, process_shared), new_array(shape, process_shared))
+        self.observed = (new_array(shape, process_shared), new_array(shape, process_shared))
+        self.writer_seq = RawValue('l', 0)
+        self.reducer_seq = RawValue('l', 0)
+
+    def writable(self):
+        """The (log_delta, observed) pair the agent should add into"""
+        active = self.writer_seq.value % 2
+        return self.log_deltas[active], self.observed[active]
+
+    def publish(self):
+        """Hands the active buffer to the reducer if it has finished with
+        the other one. Returns whether the handoff happened."""
+        if self.writer_seq.value != self.reducer_seq.value:
+            return False
+        self.writer_seq.value += 1
+        return True
+
+    def pending_log_odds(self, xs, ys):
+        """Deltas not yet in the global map at the given bins. Can be off by
+        one fold while the reducer is working, which is fine for planning."""
+        return self.log_deltas[0][xs, ys] + self.log_deltas[1][xs, ys]
+
+    def drain_into(self, log_map, observed_map, everything=False):
+        """Reducer side: folds the handed-over buffer, if there is one, into
+        the global maps. everything also folds the active buffer, which is
+        only safe once the writer has stopped."""
+        folded = 0
+        if self.reducer_seq.value < self.writer_seq.value:
+            self.fold(self.reducer_seq.value % 2, log_map, observed_map)
+            self.reducer_seq.value += 1
+            folded += 1
+        if everything:
+            self.fold(self.writer_seq.value % 2, log_map, observed_map)
+            folded += 1
+        return folded
+
+    def clear(self):
+        for array in self.log_deltas + self.observed:
+            array.fill(0)
+
+    def fold(self, index, log_map, observed_map):
+        log_delta = self.log_deltas[index]
+        observed = self.observed[index]
+        log_map += log_delta
+        np.maximum(observed_map, observed, out=observed_map)
+        log_delta.fill(0)
+        observed.fill(0)
+
+
+class SharedMap(object):
+    def __init__(self, shape, starting_log_odds=MappingAgent.STARTING_LOG_ODDS_VALUE, process_shared=False):
+        self.shape = tuple(shape)
+        self.process_shared = process_shared
+        self.log_map = new_array(self.shape, process_shared)
+        self.log_map += starting_log_odds
+        self.observed_map = new_array(self.shape, process_shared)
+        self.buffers = []
+
+    def register(self):
+        buffer = DeltaBuffer(self.shape, self.process_shared)
+        self.buffers.append(buffer)
+        return buffer
+
+    def reduce(self, everything=False):
+        """Folds every handed-over buffer into the global map. Only one
+        reducer may run at a time."""
+        folded = 0
+        for buffer in self.buffers:
+            folded += buffer.drain_into(self.log_map, self.observed_map, everything)
+        return folded
+
+    def proba_map(self):
+        return 1 / (1 + np.exp(self.log_map))
+
+    def masked_proba_map(self):
+        """Probability map with unobserved bins set to NaN, transposed like
+        the maps merge_maps works with"""
+        proba = self.proba_map()
+        proba[self.observed_map == 0] = np.nan
+        return proba.T
+
+
+class MapReducer(threading.Thread):
+    """Calls SharedMap.reduce every interval seconds until stopped, then
+    folds whatever is left once the writers are done"""
+    def __init__(self, shared_map, interval=0.01):
+        super(MapReducer, self).__init__()
+        self.daemon = True
+        self.shared_map = shared_map
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.shared_map.reduce()
+            self.stopping.wait(self.interval)
+
+    def stop(self):
+        """Call once every writer has stopped"""
+        self.stopping.set()
+        self.join()
+        self.shared_map.reduce(everything=True)
+
+
+class SharedMappingAgent(MappingAgent):
+    """MappingAgent whose log_map and observed_map are a SharedMap's global
+    maps. Its scans go into its DeltaBuffer and reach the global map through
+    the reducer; next_movement plans on the global map plus its own deltas
+    that haven't been folded in yet."""
+    def __init__(self, environment_spec, shared_map, seed=None, delta_buffer=None):
+        super(SharedMappingAgent, self).__init__(environment_spec, seed=seed)
+        assert tuple(self.BINS_PER_DIMENSION) == shared_map.shape
+        self.shared_map = shared_map
+        self.delta_buffer = delta_buffer if delta_buffer is not None else shared_map.register()
+        self.log_map = shared_map.log_map
+        self.observed_map = shared_map.observed_map
+
+    def integrate_scan(self, position, directions, distances, log_map, observed_map):
+        if log_map is not self.shared_map.log_map:
+            return super(SharedMappingAgent, self).integrate_scan(position, directions, distances, log_map, observed_map)
+        log_delta, observed_delta = self.delta_buffer.writable()
+        super(SharedMappingAgent, self).integrate_scan(position, directions, distances, log_delta, observed_delta)
+        self.delta_buffer.publish()
+        return log_map, observed_map
+
+    def mark_stale(self, xs, ys):
+        # proba_map is computed from scratch, so there's no cache to keep up
+        pass
+
+    def bin_probabilities(self, log_map, xs, ys):
+        if log_map is not self.shared_map.log_map:
+            return super(SharedMappingAgent, self).bin_probabilities(log_map, xs, ys)
+        return 1 / (1 + np.exp(log_map[xs, ys] + self.delta_buffer.pending_log_odds(xs, ys)))
+
+    def proba_map(self):
+        """The global map as this agent currently sees it"""
+        view = 1 / (1 + np.exp(self.log_map + self.delta_buffer.log_deltas[0] + self.delta_buffer.log_deltas[1]))
+        view.flags.writeable = False
+        return view
+
+    def restore_maps(self, log_map, observed_map):
+        """Copies the saved maps into the global maps in place, so every
+        agent sharing them sees the restored state, and throws away this
+        agent's unfolded deltas. Only call it while no reducer is running."""
+        self.shared_map.log_map[:] = log_map
+        self.shared_map.observed_map[:] = observed_map
+        self.delta_buffer.clear()
+        self.invalidate_proba_map()
+
+
+def run_robot(agent, mdp, steps):
+    """Drives one robot through the array fast path"""
+    observation = mdp.initial_array()
+    for _ in xrange(steps):
+        observation = mdp.fast_update(agent.fast_update(observation))
@@ -0,0 +1,200 @@
+import math
+
+import numpy as np
+
+from mapping_agent import MappingAgent
+
+
+class TiledGrid(object):
+    """2D grid split into fixed-size tiles that are only allocated once
+    something is written to them. Reads from unallocated tiles return
+    fill_value. Supports the indexing MappingAgent uses on its maps:
+    grid[x, y] with ints or with equal-length index arrays."""
+    def __init__(self, shape, tile_shape=(128, 128), fill_value=0.0, dtype=np.float64):
+        self.shape = tuple(int(n) for n in shape)
+        self.tile_shape = tuple(int(n) for n in tile_shape)
+        self.fill_value = fill_value
+        self.dtype = np.dtype(dtype)
+        self.tiles = {}
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def T(self):
+        return self.to_dense().T
+
+    @property
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    def tile(self, key):
+        if key not in self.tiles:
+            tile = np.empty(self.tile_shape, dtype=self.dtype)
+            tile.fill(self.fill_value)
+            self.tiles[key] = tile
+        return self.tiles[key]
+
+    def group_by_tile(self, xs, ys):
+        """Yields (tile key, positions in xs/ys, local xs, local ys) for
+        every tile the indices fall in"""
+        tile_xs, local_xs = np.divmod(xs, self.tile_shape[0])
+        tile_ys, local_ys = np.divmod(ys, self.tile_shape[1])
+        keys, groups = np.unique(
+            np.column_stack((tile_xs, tile_ys)),
+            axis=0,
+            return_inverse=True,
+            )
+        groups = groups.ravel()
+        if len(keys) == 1:
+            yield tuple(keys[0]), slice(None), local_xs, local_ys
+            return
+        order = np.argsort(groups, kind='mergesort')
+        bounds = np.searchsorted(groups[order], np.arange(len(keys) + 1))
+        for index, key in enumerate(keys):
+            positions = order[bounds[index]:bounds[index + 1]]
+            yield tuple(key), positions, local_xs[positions], local_ys[positions]
+
+    def split_index(self, index):
+        xs, ys = index
+        if np.ndim(xs) == 0 and np.ndim(ys) == 0:
+            return None
+        xs, ys = np.broadcast_arrays(np.asarray(xs, dtype=np.intp), np.asarray(ys, dtype=np.intp))
+        return xs.ravel(), ys.ravel()
+
+    def __getitem__(self, index):
+        arrays = self.split_index(index)
+        if arrays is None:
+            x, y = int(index[0]), int(index[1])
+            key = (x // self.tile_shape[0], y // self.tile_shape[1])
+            if key not in self.tiles:
+                return self.fill_value
+            return self.tiles[key][x % self.tile_shape[0], y % self.tile_shape[1]]
+
+        xs, ys = arrays
+        values = np.empty(len(xs), dtype=self.dtype)
+        values.fill(self.fill_value)
+        if len(xs) == 0:
+            return values
+        for key, positions, local_xs, local_ys in self.group_by_tile(xs, ys):
+            if key in self.tiles:
+                values[positions] = self.tiles[key][local_xs, local_ys]
+        return values
+
+    def __setitem__(self, index, values):
+        arrays = self.split_index(index)
+        if arrays is None:
+            x, y = int(index[0]), int(index[1])
+            tile = self.tile((x // self.tile_shape[0], y // self.tile_shape[1]))
+            tile[x % self.tile_shape[0], y % self.tile_shape[1]] = values
+            return
+
+        xs, ys = arrays
+        if len(xs) == 0:
+            return
+        values = np.broadcast_to(np.asarray(values, dtype=self.dtype), xs.shape)
+        for key, positions, local_xs, local_ys in self.group_by_tile(xs, ys):
+            self.tile(key)[local_xs, local_ys] = values[positions]
+
+    def add_at(self, index, values):
+        """np.add.at for the grid: repeated indices accumulate"""
+        xs, ys = self.split_index(index)
+        if len(xs) == 0:
+            return
+        values = np.broadcast_to(np.asarray(values, dtype=self.dtype), xs.shape)
+        for key, positions, local_xs, local_ys in self.group_by_tile(xs, ys):
+            np.add.at(self.tile(key), (local_xs, local_ys), values[positions])
+
+    def count_nonzero(self):
+        count = sum(np.count_nonzero(tile) for tile in self.tiles.values())
+        if self.fill_value != 0:
+            count += (self.tile_count() - len(self.tiles)) * self.tile_shape[0] * self.tile_shape[1]
+        return count
+
+    def tile_count(self):
+        return (
+            -(-self.shape[0] // self.tile_shape[0]) *
+            -(-self.shape[1] // self.tile_shape[1])
+            )
+
+    def __array__(self, dtype=None, copy=None):
+        # lets np.asarray, np.save and friends treat the grid as a dense map
+        dense = self.to_dense()
+        if dtype is not None:
+            dense = dense.astype(dtype, copy=False)
+        return dense
+
+    @classmethod
+    def from_dense(cls, dense, tile_shape=(128, 128), fill_value=0.0):
+        """Tiles a dense array, leaving out tiles that are all fill_value"""
+        dense = np.asarray(dense)
+        grid = cls(dense.shape, tile_shape, fill_value, dense.dtype)
+        for x in xrange(0, grid.shape[0], grid.tile_shape[0]):
+            for y in xrange(0, grid.shape[1], grid.tile_shape[1]):
+                window = dense[x:x + grid.tile_shape[0], y:y + grid.tile_shape[1]]
+                if (window == fill_value).all():
+                    continue
+                tile = grid.tile((x // grid.tile_shape[0], y // grid.tile_shape[1]))
+                tile[:window.shape[0], :window.shape[1]] = window
+        return grid
+
+    def to_dense(self):
+        dense = np.empty(self.shape, dtype=self.dtype)
+        dense.fill(self.fill_value)
+        for (tile_x, tile_y), tile in self.tiles.items():
+            x = tile_x * self.tile_shape[0]
+            y = tile_y * self.tile_shape[1]
+            window = dense[x:x + self.tile_shape[0], y:y + self.tile_shape[1]]
+            window[:] = tile[:window.shape[0], :window.shape[1]]
+        return dense
+
+
+class TiledMappingAgent(MappingAgent):
+    """MappingAgent whose maps are TiledGrids, so memory follows the
+    explored area instead of the world size. The bin count comes from
+    BIN_SIZE (metres) rather than BINS_PER_DIMENSION."""
+    BIN_SIZE = 0.1
+
+    TILE_SHAPE = (128, 128)
+
+    def bins_for(self, dimensions):
+        return (
+            int(math.ceil(dimensions[0] / self.BIN_SIZE)),
+            int(math.ceil(dimensions[1] / self.BIN_SIZE)),
+            )
+
+    def new_map(self, fill_value):
+        return TiledGrid(self.BINS_PER_DIMENSION, self.TILE_SHAPE, fill_value)
+
+    def accumulate(self, log_map, xs, ys, changes):
+        log_map.add_at((xs, ys), changes)
+
+    def proba_map(self):
+        """TiledGrid of bin probabilities, refreshed like MappingAgent's
+        and, like it, only good until the next scan"""
+        if self.proba_cache_source is not self.log_map:
+            self.invalidate_proba_map()
+        if self.proba_cache_source is None:
+            self.proba_cache = self.new_map(self.proba_from_log_odds(self.log_map.fill_value))
+            for key, tile in self.log_map.tiles.items():
+                self.proba_cache.tiles[key] = 1 / (1 + np.exp(tile))
+            self.proba_cache_source = self.log_map
+        elif self.stale_bins:
+            xs = np.concatenate([np.asarray(bins[0], dtype=np.intp) for bins in self.stale_bins])
+            ys = np.concatenate([np.asarray(bins[1], dtype=np.intp) for bins in self.stale_bins])
+            self.proba_cache[xs, ys] = 1 / (1 + np.exp(self.log_map[xs, ys]))
+        self.stale_bins = []
+        self.stale_count = 0
+        return self.proba_cache
+
+    def restore_maps(self, log_map, observed_map):
+        """Also takes dense maps, e.g. from a checkpoint, and tiles them"""
+        if not isinstance(log_map, TiledGrid):
+            log_map = TiledGrid.from_dense(log_map, self.TILE_SHAPE, self.STARTING_LOG_ODDS_VALUE)
+        if not isinstance(observed_map, TiledGrid):
+            observed_map = TiledGrid.from_dense(observed_map, self.TILE_SHAPE, 0)
+        super(TiledMappingAgent, self).restore_maps(log_map, observed_map)
+
+    def coverage(self):
+        return self.observed_map.count_nonzero() / float(self.observed_map.size)
@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+
+from agents import SingleAgentID
+from actions import ComponentName
+from observations import FeatureName
+
+
+READING_NAMES = ('north', 'east', 'south', 'west')
+
+RECORD_DTYPE = np.dtype([
+    ('step', '<i4'),
+    ('position', '<f8', (2,)),
+    ('readings', '<f8', (len(READING_NAMES),)),
+    ('action', '<f8', (2,)),
+    ])
+
+# steps folded into one integrate_scan call during replay
+REPLAY_CHUNK_SIZE = 4096
+
+
+class TrajectoryRecorder(object):
+    """Appends one fixed-size RECORD_DTYPE record per step to a file, so a
+    run can later be replayed into an agent without the simulator"""
+    feature_names = dict((name, FeatureName(name)) for name in ('x', 'y') + READING_NAMES)
+    component_names = {
+        'x': ComponentName('x'),
+        'y': ComponentName('y'),
+        }
+
+    def __init__(self, file_name):
+        self.file = open(file_name, 'ab')
+        self.agent_id = SingleAgentID()
+        self.record = np.zeros((), dtype=RECORD_DTYPE)
+
+    def record_step(self, step, observation_map, action_map):
+        observation = observation_map.observations[self.agent_id]
+        action = action_map.get_action(self.agent_id)
+        self.write(
+            step,
+            [observation.get_value(self.feature_names[name]).feature_value for name in ('x', 'y')],
+            [observation.get_value(self.feature_names[name]).feature_value for name in READING_NAMES],
+            [action.get_component(self.component_names[name]).action_value for name in ('x', 'y')],
+            )
+
+    def write(self, step, position, readings, action):
+        self.record['step'] = step
+        self.record['position'] = position
+        self.record['readings'] = readings
+        self.record['action'] = action
+        self.file.write(self.record.tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+def read_trajectory(file_name):
+    """Memory-maps a recorded file as a RECORD_DTYPE array"""
+    if os.path.getsize(file_name) == 0:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    return np.memmap(file_name, dtype=RECORD_DTYPE, mode='r')
+
+
+def replay(file_name, agent):
+    """Feeds recorded readings into the agent's maps as if it had taken
+    those steps itself, many steps per integrate_scan call. Only the map
+    update is replayed; the agent's own movement choices aren't consulted."""
+    records = read_trajectory(file_name)
+    directions = np.array([agent.direction_bases[name] for name in READING_NAMES], dtype=np.float64)
+    for low in xrange(0, len(records), REPLAY_CHUNK_SIZE):
+        chunk = records[low:low + REPLAY_CHUNK_SIZE]
+        agent.log_map, agent.observed_map = agent.integrate_scan(
+            np.repeat(chunk['position'], len(READING_NAMES), axis=0),
+            np.tile(directions, (len(chunk), 1)),
+            chunk['readings'].ravel(),
+            agent.log_map,
+            agent.observed_map,
+            )
+    if len(records) > 0:
+        agent.position = tuple(records[-1]['position'])
+    return agent
@@ -0,0 +1,98 @@
+import numpy as np
+
+
+# keeps the (segments x walls) temporaries to a few MB
+MAX_PAIRS_PER_CHUNK = 2 ** 18
+
+
+def cross(a_x, a_y, b_x, b_y):
+    return a_x * b_y - a_y * b_x
+
+
+def ccw(a_x, a_y, b_x, b_y, c_x, c_y):
+    return (c_y - a_y) * (b_x - a_x) > (b_y - a_y) * (c_x - a_x)
+
+
+def nearest_hits(starts, ends, walls):
+    """For each segment starts[i] -> ends[i], the fraction of the way along
+    it at which it first crosses a wall, or inf if it crosses none. Uses the
+    same orientation test as LineSegment.intersects, so touching endpoints
+    are resolved the same way as the scalar code."""
+    return first_hits(starts, ends, walls)[0]
+
+
+def first_hits(starts, ends, walls):
+    """nearest_hits along with the row of walls each segment hits first,
+    or -1 where it hits none"""
+    starts = np.asarray(starts, dtype=np.float64).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+    walls = np.asarray(walls, dtype=np.float64).reshape(-1, 4)
+    hits = np.empty(len(starts))
+    hits.fill(np.inf)
+    indices = np.empty(len(starts), dtype=np.intp)
+    indices.fill(-1)
+    if len(walls) == 0:
+        return hits, indices
+
+    chunk = max(1, MAX_PAIRS_PER_CHUNK // len(walls))
+    a_x, a_y, b_x, b_y = walls.T
+    wall_dx = b_x - a_x
+    wall_dy = b_y - a_y
+    for low in xrange(0, len(starts), chunk):
+        high = low + chunk
+        c_x = starts[low:high, 0, None]
+        c_y = starts[low:high, 1, None]
+        d_x = ends[low:high, 0, None]
+        d_y = ends[low:high, 1, None]
+        crossing = (
+            (ccw(a_x, a_y, c_x, c_y, d_x, d_y) != ccw(b_x, b_y, c_x, c_y, d_x, d_y)) &
+            (ccw(a_x, a_y, b_x, b_y, c_x, c_y) != ccw(a_x, a_y, b_x, b_y, d_x, d_y))
+            )
+        seg_dx = d_x - c_x
+        seg_dy = d_y - c_y
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = cross(a_x - c_x, a_y - c_y, wall_dx, wall_dy) / cross(seg_dx, seg_dy, wall_dx, wall_dy)
+        t = np.where(crossing, t, np.inf)
+        first = t.argmin(axis=1)
+        hits[low:high] = t[np.arange(len(first)), first]
+        indices[low:high] = np.where(np.isinf(hits[low:high]), -1, first)
+    return hits, indices
+
+
+def pair_hits(starts, ends, walls, segments, wall_indices):
+    """nearest_hits for explicit (segment, wall) pairs: the fraction along
+    starts[segments[k]] -> ends[segments[k]] at which it crosses
+    walls[wall_indices[k]], or inf if it doesn't"""
+    c_x, c_y = starts[segments, 0], starts[segments, 1]
+    d_x, d_y = ends[segments, 0], ends[segments, 1]
+    a_x, a_y, b_x, b_y = walls[wall_indices].T
+    crossing = (
+        (ccw(a_x, a_y, c_x, c_y, d_x, d_y) != ccw(b_x, b_y, c_x, c_y, d_x, d_y)) &
+        (ccw(a_x, a_y, b_x, b_y, c_x, c_y) != ccw(a_x, a_y, b_x, b_y, d_x, d_y))
+        )
+    wall_dx = b_x - a_x
+    wall_dy = b_y - a_y
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = cross(a_x - c_x, a_y - c_y, wall_dx, wall_dy) / cross(d_x - c_x, d_y - c_y, wall_dx, wall_dy)
+    return np.where(crossing, t, np.inf)
+
+
+def beam_angles(beam_count):
+    """Evenly spaced beam angles, counterclockwise from east"""
+    return np.linspace(0, 2 * np.pi, beam_count, endpoint=False)
+
+
+def cast_beams(origin, angles, walls, max_range):
+    """Distance to the nearest wall along each beam from origin, inf where a
+    beam sees nothing within max_range. Every beam is tested against every
+    wall; WallGrid.cast_beams only tests the walls near each beam."""
+    starts, ends = beam_segments(origin, angles, max_range)
+    return nearest_hits(starts, ends, walls) * max_range
+
+
+def beam_segments(origin, angles, max_range):
+    angles = np.asarray(angles, dtype=np.float64)
+    starts = np.empty((len(angles), 2))
+    starts[:] = origin
+    ends = starts + max_range * np.column_stack((np.cos(angles), np.sin(angles)))
+    return starts, ends
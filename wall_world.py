@@ -1,13 +1,23 @@
 from sets import Set
 import math
 
+import numpy as np
+
 from actions import ComponentName
 from observations import NumericFeatureValue
 from observations import Observation
 from agents import SingleAgentID
+from vector_geometry import beam_angles
+from vector_geometry import beam_segments
+from vector_geometry import cast_beams
+from vector_geometry import pair_hits
+from instrumentation import NULL_PROFILER
+from distance_field import DistanceField
 
 
 class LineSegment(object):
+    __slots__ = ('endpoints',)
+
     def __init__(self, endpoints):
         self.endpoints = endpoints
 
@@ -53,15 +63,28 @@ class LineSegment(object):
 
 
 class Wall(LineSegment):
+    __slots__ = ()
+
     def __init__(self, endpoints):
         super(Wall, self).__init__(endpoints)
 
+    @classmethod
+    def from_row(cls, row):
+        return cls((Point(row[0], row[1]), Point(row[2], row[3])))
+
+    def as_row(self):
+        return (self.endpoints[0].x, self.endpoints[0].y, self.endpoints[1].x, self.endpoints[1].y)
+
 class Trajectory(LineSegment):
+    __slots__ = ()
+
     def __init__(self, endpoints):
         super(Trajectory, self).__init__(endpoints)
 
 
 class Point(object):
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y):
         self.x = float(x)
         self.y = float(y)
@@ -74,6 +97,8 @@ class Point(object):
 
 
 class Direction(object):
+    __slots__ = ('x_component', 'y_component')
+
     def __init__(self, components):
         self.x_component = components[0]
         self.y_component = components[1]
@@ -82,6 +107,190 @@ class Direction(object):
         return "<" + str(self.x_component) + ", " + str(self.y_component) + ">"
 
 
+class WallGrid(object):
+    """Uniform grid over the world that buckets wall rows by cell, so that
+    a trajectory only has to be tested against the walls in the cells it
+    passes through. Each bucket entry is an (index, x1, y1, x2, y2) tuple so
+    the query loop never has to go back to Wall objects or the array."""
+    def __init__(self, dimensions, cell_size):
+        self.cell_size = float(cell_size)
+        self.columns = max(1, int(math.ceil(dimensions[0] / self.cell_size)))
+        self.rows = max(1, int(math.ceil(dimensions[1] / self.cell_size)))
+        self.cells = {}
+        # flattened copy of cells for the batched queries, see bucket_arrays
+        self.buckets = None
+        self.profiler = NULL_PROFILER
+
+    # cast_beams first looks this many cells out, then twice as far each round
+    FIRST_BEAM_REACH = 4
+    # below this many walls testing every beam against every wall is quicker
+    BRUTE_FORCE_WALLS = 64
+
+    def add(self, index, wall_row):
+        # bucket by bounding box, which is exact for the axis-aligned walls
+        # we mostly have and conservative for everything else
+        # padded a hair so a wall ending exactly on a cell boundary is also
+        # in the cell on the other side, which a ray through a corner may use
+        entry = (index,) + tuple(float(coordinate) for coordinate in wall_row)
+        pad = self.cell_size * 1e-9
+        low_col, low_row = self.cell_of(min(wall_row[0], wall_row[2]) - pad, min(wall_row[1], wall_row[3]) - pad)
+        high_col, high_row = self.cell_of(max(wall_row[0], wall_row[2]) + pad, max(wall_row[1], wall_row[3]) + pad)
+        for col in xrange(low_col, high_col + 1):
+            for row in xrange(low_row, high_row + 1):
+                self.cells.setdefault((col, row), []).append(entry)
+        self.buckets = None
+
+    def bucket_arrays(self):
+        """(offsets, wall indices) with the walls of cell (col, row) at
+        wall_indices[offsets[i]:offsets[i + 1]], i = col * rows + row"""
+        if self.buckets is None:
+            counts = np.zeros(self.columns * self.rows, dtype=np.intp)
+            members = []
+            for (col, row), entries in sorted(self.cells.items()):
+                counts[col * self.rows + row] = len(entries)
+                members.extend(entry[0] for entry in entries)
+            offsets = np.concatenate(([0], np.cumsum(counts)))
+            self.buckets = (offsets, np.array(members, dtype=np.intp))
+        return self.buckets
+
+    def cast_beams(self, origin, angles, wall_array, max_range):
+        """Same distances as vector_geometry.cast_beams, but each beam is
+        only tested against the walls in the cells it passes through. The
+        beams are walked out a few cells at a time, all together, and a
+        beam stops once it has a hit closer than how far it has been walked."""
+        if len(wall_array) < self.BRUTE_FORCE_WALLS:
+            return cast_beams(origin, angles, wall_array, max_range)
+        starts, ends = beam_segments(origin, angles, max_range)
+        offsets, members = self.bucket_arrays()
+        nearest = np.empty(len(starts))
+        nearest.fill(np.inf)
+        active = np.arange(len(starts))
+        walked = 0.0
+        reach = self.FIRST_BEAM_REACH * self.cell_size
+        while len(active):
+            reach = min(reach, max_range)
+            stretch = (ends[active] - starts[active]) / max_range
+            cells, beams = self.cells_touched(starts[active] + walked * stretch, starts[active] + reach * stretch)
+            counts = offsets[cells + 1] - offsets[cells]
+            pair_beams = np.repeat(active[beams], counts)
+            first = np.repeat(offsets[cells] - (np.cumsum(counts) - counts), counts)
+            pair_walls = members[first + np.arange(len(pair_beams))]
+            self.profiler.count('walls_tested', len(pair_walls))
+            if len(pair_walls):
+                np.minimum.at(nearest, pair_beams, pair_hits(starts, ends, wall_array, pair_beams, pair_walls))
+            if reach >= max_range:
+                break
+            active = active[nearest[active] * max_range > reach]
+            walked = reach
+            reach *= 2
+        return nearest * max_range
+
+    def cells_touched(self, starts, ends):
+        """(flat cell indices, segment) pairs covering every cell each
+        segment touches, with repeats: its end cells, plus the cells on
+        both sides of every grid line it crosses. Cheaper than an ordered
+        traversal when the order doesn't matter."""
+        starts = starts / self.cell_size
+        ends = ends / self.cell_size
+        upper = np.array([self.columns - 1, self.rows - 1])
+        segments = np.arange(len(starts))
+        cells = [np.minimum(np.maximum(np.floor(points), 0), upper).astype(np.intp) for points in (starts, ends)]
+        beams = [segments, segments]
+        for axis in (0, 1):
+            other = 1 - axis
+            low = np.floor(np.minimum(starts[:, axis], ends[:, axis])).astype(np.intp)
+            counts = np.floor(np.maximum(starts[:, axis], ends[:, axis])).astype(np.intp) - low
+            crossing_segments = np.repeat(segments, counts)
+            lines = np.arange(len(crossing_segments)) - np.repeat(np.cumsum(counts) - counts, counts)
+            lines += low[crossing_segments] + 1
+            delta = ends[crossing_segments] - starts[crossing_segments]
+            across = starts[crossing_segments, other] + (
+                (lines - starts[crossing_segments, axis]) / delta[:, axis] * delta[:, other]
+                )
+            across = np.minimum(np.maximum(np.floor(across), 0), upper[other]).astype(np.intp)
+            for side in (lines - 1, lines):
+                side_cells = np.empty((len(crossing_segments), 2), dtype=np.intp)
+                side_cells[:, axis] = np.minimum(np.maximum(side, 0), upper[axis])
+                side_cells[:, other] = across
+                cells.append(side_cells)
+                beams.append(crossing_segments)
+        cells = np.concatenate(cells)
+        return cells[:, 0] * self.rows + cells[:, 1], np.concatenate(beams)
+
+    def cell_of(self, x, y):
+        col = int(math.floor(x / self.cell_size))
+        row = int(math.floor(y / self.cell_size))
+        return (
+            min(max(col, 0), self.columns - 1),
+            min(max(row, 0), self.rows - 1),
+            )
+
+    def traverse(self, segment):
+        """Yields (cell, exit distance) for every cell the segment passes
+        through, in order from its first endpoint (Amanatides-Woo)"""
+        start, end = segment.endpoints
+        length = start.distance(end)
+        col, row = self.cell_of(start.x, start.y)
+        col_step, col_t_max, col_t_delta = self.traversal_axis(start.x, end.x, col)
+        row_step, row_t_max, row_t_delta = self.traversal_axis(start.y, end.y, row)
+        while True:
+            t_exit = min(col_t_max, row_t_max, 1.0)
+            yield (col, row), t_exit * length
+            if t_exit >= 1.0:
+                return
+            if col_t_max < row_t_max:
+                col += col_step
+                col_t_max += col_t_delta
+            else:
+                row += row_step
+                row_t_max += row_t_delta
+            if not (0 <= col < self.columns and 0 <= row < self.rows):
+                return
+
+    def traversal_axis(self, start, end, index):
+        delta = end - start
+        if delta > 0:
+            return 1, ((index + 1) * self.cell_size - start) / delta, self.cell_size / delta
+        elif delta < 0:
+            return -1, (index * self.cell_size - start) / delta, -self.cell_size / delta
+        else:
+            return 0, float('inf'), float('inf')
+
+    def nearest_hit(self, trajectory):
+        """Fraction of the way along the trajectory at which it first crosses
+        a wall, or None. Uses the same orientation test as
+        LineSegment.intersects."""
+        start, end = trajectory.endpoints
+        c_x, c_y, d_x, d_y = start.x, start.y, end.x, end.y
+        seg_dx = d_x - c_x
+        seg_dy = d_y - c_y
+        nearest = None
+        length = math.hypot(seg_dx, seg_dy)
+        tested = Set()
+        for cell, exit_distance in self.traverse(trajectory):
+            for index, a_x, a_y, b_x, b_y in self.cells.get(cell, ()):
+                if index in tested:
+                    continue
+                tested.add(index)
+                # ccw(A, C, D) != ccw(B, C, D) and ccw(A, B, C) != ccw(A, B, D)
+                if (((d_y - a_y) * (c_x - a_x) > (c_y - a_y) * (d_x - a_x)) ==
+                        ((d_y - b_y) * (c_x - b_x) > (c_y - b_y) * (d_x - b_x))):
+                    continue
+                wall_dx = b_x - a_x
+                wall_dy = b_y - a_y
+                if ((c_y - a_y) * wall_dx > wall_dy * (c_x - a_x)) == ((d_y - a_y) * wall_dx > wall_dy * (d_x - a_x)):
+                    continue
+                t = ((a_x - c_x) * wall_dy - (a_y - c_y) * wall_dx) / (seg_dx * wall_dy - seg_dy * wall_dx)
+                if nearest is None or t < nearest:
+                    nearest = t
+            # walls beyond this cell can't be hit before anything found so far
+            if nearest is not None and nearest * length <= exit_distance:
+                break
+        self.profiler.count('walls_tested', len(tested))
+        self.profiler.count('wall_queries')
+        return nearest
+
+
 class World(object):
     directions = {
         'north': Direction((0, 1)),
@@ -93,23 +302,47 @@ class World(object):
         'x': ComponentName('x'),
         'y': ComponentName('y'),
         }
+    WALL_GRID_CELL_SIZE = 1.0
+
+    INITIAL_WALL_CAPACITY = 64
+
+    # slots of the array observation_array fills
+    OBSERVATION_LAYOUT = ('x', 'y', 'north', 'east', 'south', 'west')
 
-    def __init__(self, dimensions, feature_names, robot_position):
+    def __init__(self, dimensions, feature_names, robot_position, beam_count=None, walls=None, border=0.9):
+        """walls is an (N, 4) array of x1, y1, x2, y2 rows in world
+        coordinates; without it the walls are read from wall_list.txt.
+        border is how far in from the edges the enclosing walls go, or None
+        for no enclosing walls."""
         self.dimensions = dimensions
         self.feature_names = feature_names
+        # optional lidar-style sweep reported alongside the four directions
+        self.beam_angles = beam_angles(beam_count) if beam_count else None
         self.add_robot(Point(robot_position[0], robot_position[1]))
-        self.walls = Set()
+        # one x1, y1, x2, y2 row per wall, grown by doubling
+        self.wall_rows = np.empty((self.INITIAL_WALL_CAPACITY, 4))
+        self.wall_count = 0
+        self.wall_views = None
+        # see enable_distance_field
+        self.distance_field_resolution = None
+        self.distance_field = None
+        self.wall_grid = WallGrid(dimensions, self.WALL_GRID_CELL_SIZE)
         self.agent = SingleAgentID()
-        bottom_left = Point(0.9, 0.9)
-        top_left = Point(0.9, dimensions[1] - 0.9)
-        top_right = Point(dimensions[0] - 0.9, dimensions[1] - 0.9)
-        bottom_right = Point(dimensions[0] - 0.9, 0.9)
-        self.add_wall(Wall((bottom_left, top_left)))
-        self.add_wall(Wall((top_left, top_right)))
-        self.add_wall(Wall((top_right, bottom_right)))
-        self.add_wall(Wall((bottom_right, bottom_left)))
-
-        self.read_walls_from_file('wall_list.txt')
+        self.profiler = NULL_PROFILER
+        if border is not None:
+            bottom_left = Point(border, border)
+            top_left = Point(border, dimensions[1] - border)
+            top_right = Point(dimensions[0] - border, dimensions[1] - border)
+            bottom_right = Point(dimensions[0] - border, border)
+            self.add_wall(Wall((bottom_left, top_left)))
+            self.add_wall(Wall((top_left, top_right)))
+            self.add_wall(Wall((top_right, bottom_right)))
+            self.add_wall(Wall((bottom_right, bottom_left)))
+
+        if walls is None:
+            self.read_walls_from_file('wall_list.txt')
+        else:
+            self.add_walls(walls)
         """
         traj = Trajectory((self.robot_location, Point(self.robot_location.x, self.robot_location.y - 1)))
         print "intersections: "
@@ -122,36 +355,94 @@ class World(object):
             """
 
     def read_walls_from_file(self, file_name):
-        with open(file_name, 'r') as f:
-            walls_list = f.readlines()
-
-        split_coordinates = [wall.split(',') for wall in walls_list]
-        wall_coordinates = []
-        for wall in split_coordinates:
-            wall_coordinates.append([float(coord.strip()) + 1 for coord in wall])
-        for wall in wall_coordinates:
-            start = Point(wall[0], wall[1])
-            end = Point(wall[2], wall[3])
-            self.add_wall(Wall((start, end)))
+        wall_coordinates = np.loadtxt(file_name, delimiter=',', ndmin=2) + 1
+        self.add_walls(wall_coordinates)
 
     def add_wall(self, wall):
+        self.add_walls(np.array([wall.as_row()]))
+
+    def add_walls(self, wall_coordinates):
+        """Adds an (N, 4) array of x1, y1, x2, y2 walls"""
+        wall_coordinates = np.asarray(wall_coordinates, dtype=np.float64).reshape(-1, 4)
         # This lets walls intersect but I'm ok with that
-        assert self.in_boundaries(wall.endpoints[0])
-        assert self.in_boundaries(wall.endpoints[1])
-        self.walls.add(wall)
+        assert self.rows_in_boundaries(wall_coordinates[:, :2]).all()
+        assert self.rows_in_boundaries(wall_coordinates[:, 2:]).all()
+        needed = self.wall_count + len(wall_coordinates)
+        if needed > len(self.wall_rows):
+            capacity = len(self.wall_rows)
+            while capacity < needed:
+                capacity *= 2
+            grown = np.empty((capacity, 4))
+            grown[:self.wall_count] = self.wall_rows[:self.wall_count]
+            self.wall_rows = grown
+        self.wall_rows[self.wall_count:needed] = wall_coordinates
+        for index in xrange(self.wall_count, needed):
+            self.wall_grid.add(index, self.wall_rows[index])
+        self.wall_count = needed
+        self.wall_views = None
+        self.distance_field = None
+
+    def enable_distance_field(self, resolution=0.1):
+        """Answers distance_in_direction from a DistanceField at this
+        resolution where it can, instead of raycasting. The field is built
+        on the next reading and again after any wall is added."""
+        self.distance_field_resolution = resolution
+        self.distance_field = None
+
+    def wall_array(self):
+        """(N, 4) view of the walls' endpoint coordinates"""
+        return self.wall_rows[:self.wall_count]
+
+    @property
+    def walls(self):
+        """The walls as Wall objects, for code that wants to iterate them"""
+        if self.wall_views is None:
+            self.wall_views = tuple(Wall.from_row(row) for row in self.wall_array())
+        return self.wall_views
+
+    def rows_in_boundaries(self, points):
+        return (
+            (points[:, 0] >= 0) & (points[:, 0] <= self.dimensions[0]) &
+            (points[:, 1] >= 0) & (points[:, 1] <= self.dimensions[1])
+            )
 
     def add_robot(self, location):
         assert self.in_boundaries(location)
         self.robot_location = location
 
+    def set_profiler(self, profiler):
+        self.profiler = profiler
+        self.wall_grid.profiler = profiler
+
     def make_observation(self):
+        with self.profiler.timer('make_observation'):
+            return self.build_observation()
+
+    def build_observation(self):
         observation = Observation()
         observation.add_feature(self.feature_names['x'], NumericFeatureValue(self.robot_location.x))
         observation.add_feature(self.feature_names['y'], NumericFeatureValue(self.robot_location.y))
         for dir in self.directions.keys():
             observation.add_feature(self.feature_names[dir], NumericFeatureValue(self.distance_in_direction(self.directions[dir])))
+        if self.beam_angles is not None:
+            observation.add_feature(self.feature_names['scan'], NumericFeatureValue(self.scan(self.beam_angles)))
         return observation
 
+    def observation_array(self, out=None):
+        """make_observation as a flat float array in OBSERVATION_LAYOUT
+        order, written into out if given"""
+        if out is None:
+            out = np.empty(len(self.OBSERVATION_LAYOUT))
+        with self.profiler.timer('make_observation'):
+            out[0] = self.robot_location.x
+            out[1] = self.robot_location.y
+            for index in xrange(2, len(self.OBSERVATION_LAYOUT)):
+                out[index] = self.distance_in_direction(self.directions[self.OBSERVATION_LAYOUT[index]])
+        return out
+
+    def move_to(self, x, y):
+        self.robot_location = self.move_robot(Point(x, y))
+
     def initial_state(self):
         return self.make_observation()
 
@@ -166,14 +457,14 @@ class World(object):
         assert self.robot_location is not None
         assert self.in_boundaries(destination)
         trajectory = Trajectory((self.robot_location, destination))
-        intersections = self.intersections(self.walls, trajectory)
-        if len(intersections) == 0:
+        with self.profiler.timer('raycast'):
+            closest_intersection = self.nearest_intersection(trajectory)
+        if closest_intersection is None:
             new_location = destination
 
         else:
             # if the movement would run into a wall, end the movement a short distance away from the wall
             collision_distance = 0.1
-            closest_intersection = self.closest_intersection(intersections)
             x_movement_diff = destination.x - self.robot_location.x
             y_movement_diff = destination.y - self.robot_location.y
             x_offset = -1 * collision_distance * x_movement_diff
@@ -195,6 +486,28 @@ class World(object):
         y = location.y
         return 0 <= x <= self.dimensions[0] and 0 <= y <= self.dimensions[1]
 
+    def nearest_intersection(self, trajectory):
+        """Closest point where the trajectory crosses a wall, or None"""
+        fraction = self.wall_grid.nearest_hit(trajectory)
+        if fraction is None:
+            return None
+        return self.point_along(trajectory, fraction)
+
+    def point_along(self, trajectory, fraction):
+        start, end = trajectory.endpoints
+        return Point(start.x + fraction * (end.x - start.x), start.y + fraction * (end.y - start.y))
+
+    def wall_crossing(self, trajectory, wall_index):
+        """Fraction along the trajectory where it crosses the line through
+        the given wall, worked out exactly as WallGrid.nearest_hit does"""
+        start, end = trajectory.endpoints
+        a_x, a_y, b_x, b_y = self.distance_field.wall_rows[wall_index]
+        wall_dx = b_x - a_x
+        wall_dy = b_y - a_y
+        seg_dx = end.x - start.x
+        seg_dy = end.y - start.y
+        return (((a_x - start.x) * wall_dy - (a_y - start.y) * wall_dx) / (seg_dx * wall_dy - seg_dy * wall_dx))
+
     def intersections(self, walls, trajectory):
         intersections = Set()
         for wall in walls:
@@ -204,10 +517,29 @@ class World(object):
 
     def distance_in_direction(self, direction):
         traj = Trajectory((self.robot_location, Point(self.robot_location.x + direction.x_component * self.dimensions[0] * 2, self.robot_location.y + direction.y_component * self.dimensions[1] * 2)))
-        intersections = self.intersections(self.walls, traj)
-        assert len(intersections) > 0, str(traj)
-
-        return self.robot_location.distance(self.closest_intersection(intersections))
+        if self.distance_field_resolution is not None:
+            if self.distance_field is None:
+                self.distance_field = DistanceField(self.wall_array(), self.dimensions, self.distance_field_resolution)
+            wall_index = self.distance_field.wall_index(
+                self.robot_location.x,
+                self.robot_location.y,
+                (direction.x_component, direction.y_component),
+                )
+            if wall_index >= 0:
+                return self.robot_location.distance(self.point_along(traj, self.wall_crossing(traj, wall_index)))
+        with self.profiler.timer('raycast'):
+            closest_intersection = self.nearest_intersection(traj)
+        assert closest_intersection is not None, str(traj)
+
+        return self.robot_location.distance(closest_intersection)
+
+    def scan(self, angles):
+        """Array of distances to the nearest wall along each beam angle
+        (radians counterclockwise from east) from the robot"""
+        max_range = 2 * math.hypot(self.dimensions[0], self.dimensions[1])
+        origin = (self.robot_location.x, self.robot_location.y)
+        with self.profiler.timer('raycast'):
+            return self.wall_grid.cast_beams(origin, angles, self.wall_array(), max_range)
 
     def closest_intersection(self, intersections):
         return min(intersections, key=lambda point: self.robot_location.distance(point))
@@ -1,5 +1,7 @@
 import math
 
+import numpy as np
+
 from messages import EnvironmentSpec
 from messages import EpisodeTerminationSignal
 from environments import MarkovDecisionProcess
@@ -26,15 +28,26 @@ class WallWorldMDP(MarkovDecisionProcess):
         'east': FeatureName('east'),
         'south': FeatureName('south'),
         'west': FeatureName('west'),
+        'scan': FeatureName('scan'),
         }
 
-    def __init__(self, robot_position):
-        self.dimensions = (12, 12)
-        self.world = World(self.dimensions, self.feature_names, robot_position)
+    def __init__(self, robot_position, beam_count=None, dimensions=(12, 12), walls=None, border=0.9):
+        """The default is the 12x12 world from wall_list.txt; pass
+        dimensions and walls (see world_generator) for anything else"""
+        self.dimensions = tuple(dimensions)
+        self.beam_count = beam_count
+        self.world = World(self.dimensions, self.feature_names, robot_position, beam_count, walls, border)
+        self.observation_buffer = np.empty(len(World.OBSERVATION_LAYOUT))
         self.reward = Reward(None)
         self.termination_signal = EpisodeTerminationSignal(False)
         self.agent = SingleAgentID()
 
+    def set_profiler(self, profiler):
+        self.world.set_profiler(profiler)
+
+    def robot_position(self):
+        return (self.world.robot_location.x, self.world.robot_location.y)
+
     def spec(self):
         action_descriptors = AllActionDescriptors()
         x_component_name = ComponentName('x')
@@ -66,6 +79,9 @@ class WallWorldMDP(MarkovDecisionProcess):
             max_value = NumericFeatureValue(farthest_distance)
             direction_descriptor = ContinuousFeatureDescriptor(min_value, max_value)
             feature_descriptors.add_descriptor(self.feature_names[name], direction_descriptor)
+        if self.beam_count:
+            scan_descriptor = ContinuousFeatureDescriptor(NumericFeatureValue(0), NumericFeatureValue(farthest_distance))
+            feature_descriptors.add_descriptor(self.feature_names['scan'], scan_descriptor)
         spec = EnvironmentSpec(action_descriptors, feature_descriptors)
         return spec
 
@@ -80,3 +96,15 @@ class WallWorldMDP(MarkovDecisionProcess):
         observation = self.world.update(action_map, term_signal)
         observation_map.add_observation(self.agent, observation)
         return observation_map, self.reward, self.termination_signal
+
+    def initial_array(self):
+        """Array counterpart of initial_state: the observation as a
+        World.OBSERVATION_LAYOUT array. The same buffer is reused every
+        step, so copy it to keep it."""
+        return self.world.observation_array(self.observation_buffer)
+
+    def fast_update(self, destination):
+        """Array counterpart of update: moves the robot towards the (x, y)
+        destination and returns the new observation array"""
+        self.world.move_to(destination[0], destination[1])
+        return self.world.observation_array(self.observation_buffer)
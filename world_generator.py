@@ -0,0 +1,126 @@
+"""Seeded procedural worlds (rooms, corridors and clutter) of any size, for
+testing how the simulator and mapper scale beyond wall_list.txt.
+
+    world = generate_world((200, 200), seed=3, wall_count=20000)
+    mdp = WallWorldMDP(world.start_positions[0], dimensions=world.dimensions, walls=world.walls)
+
+Walls come back as an (N, 4) array of x1, y1, x2, y2 rows in world
+coordinates, which World.add_walls takes directly."""
+import numpy as np
+
+
+class GeneratedWorld(object):
+    def __init__(self, dimensions, walls, start_positions, border):
+        self.dimensions = dimensions
+        self.walls = walls
+        self.start_positions = start_positions
+        self.border = border
+
+    def __len__(self):
+        return len(self.walls)
+
+    def make_mdp(self, start_index=0, beam_count=None):
+        # imported here so the generator doesn't need the MDP framework
+        from wall_world_mdp import WallWorldMDP
+        start = tuple(self.start_positions[start_index])
+        return WallWorldMDP(start, beam_count, dimensions=self.dimensions, walls=self.walls, border=self.border)
+
+
+def generate_world(
+        dimensions,
+        seed=0,
+        room_size=4.0,
+        door_width=1.0,
+        corridor_fraction=0.3,
+        wall_count=None,
+        clutter_length=0.6,
+        clearance=0.5,
+        start_count=16,
+        border=0.9,
+        ):
+    """Splits the area inside the border into a grid of rooms of roughly
+    room_size. Every wall between two rooms either gets a door_width gap or,
+    with probability corridor_fraction, is left out so neighbouring rooms
+    join up into corridors and halls. Short clutter walls are then scattered
+    inside the rooms until there are wall_count walls, keeping clear of the
+    room centres, which are the start positions."""
+    rand = np.random.RandomState(seed)
+    x_edges = room_edges(border, dimensions[0] - border, room_size)
+    y_edges = room_edges(border, dimensions[1] - border, room_size)
+
+    walls = []
+    # vertical walls between rooms: one per interior x edge and row of rooms
+    xs, rows = np.meshgrid(x_edges[1:-1], np.arange(len(y_edges) - 1), indexing='ij')
+    walls.append(doorway_walls(
+        rand, xs.ravel(), y_edges[rows.ravel()], y_edges[rows.ravel() + 1], door_width, corridor_fraction, vertical=True))
+    ys, cols = np.meshgrid(y_edges[1:-1], np.arange(len(x_edges) - 1), indexing='ij')
+    walls.append(doorway_walls(
+        rand, ys.ravel(), x_edges[cols.ravel()], x_edges[cols.ravel() + 1], door_width, corridor_fraction, vertical=False))
+
+    centre_xs = (x_edges[:-1] + x_edges[1:]) / 2
+    centre_ys = (y_edges[:-1] + y_edges[1:]) / 2
+    centres = np.array([(x, y) for x in centre_xs for y in centre_ys])
+
+    structural = sum(len(w) for w in walls)
+    if wall_count is not None and wall_count > structural:
+        walls.append(clutter_walls(rand, x_edges, y_edges, wall_count - structural, clutter_length, clearance))
+    walls = np.concatenate(walls).reshape(-1, 4)
+
+    order = rand.permutation(len(centres))[:start_count]
+    return GeneratedWorld(tuple(dimensions), walls, centres[order], border)
+
+
+def room_edges(low, high, room_size):
+    rooms = max(1, int((high - low) // room_size))
+    return np.linspace(low, high, rooms + 1)
+
+
+def doorway_walls(rand, positions, starts, ends, door_width, corridor_fraction, vertical):
+    """Two wall pieces either side of a door gap for each boundary from
+    starts to ends at the fixed coordinate positions, dropping a
+    corridor_fraction of the boundaries entirely"""
+    keep = rand.random_sample(len(positions)) >= corridor_fraction
+    positions, starts, ends = positions[keep], starts[keep], ends[keep]
+    gap = np.minimum(door_width, (ends - starts) / 2)
+    # door somewhere in the middle of the boundary, away from the corners
+    slack = (ends - starts - gap) / 2
+    door_low = starts + slack / 2 + rand.random_sample(len(positions)) * slack
+    door_high = door_low + gap
+    pieces = np.concatenate([
+        np.column_stack([positions, starts, positions, door_low]),
+        np.column_stack([positions, door_high, positions, ends]),
+        ])
+    if not vertical:
+        pieces = pieces[:, [1, 0, 3, 2]]
+    return pieces
+
+
+def clutter_walls(rand, x_edges, y_edges, count, length, clearance):
+    """count short walls at random angles, each inside a single room and
+    at least clearance from that room's centre"""
+    half = length / 2
+    # keep the whole segment a little inside its room
+    margin = half + 0.1
+    reach_x = (x_edges[1:] - x_edges[:-1]).min() / 2 - margin
+    reach_y = (y_edges[1:] - y_edges[:-1]).min() / 2 - margin
+    if reach_x <= 0 or reach_y <= 0 or np.hypot(reach_x, reach_y) <= clearance + half:
+        raise ValueError('rooms are too small for clutter of length %s' % length)
+    walls = np.empty((0, 4))
+    while len(walls) < count:
+        needed = count - len(walls)
+        cols = rand.randint(len(x_edges) - 1, size=needed)
+        rows = rand.randint(len(y_edges) - 1, size=needed)
+        x_low, x_high = x_edges[cols] + margin, x_edges[cols + 1] - margin
+        y_low, y_high = y_edges[rows] + margin, y_edges[rows + 1] - margin
+        mid_x = x_low + rand.random_sample(needed) * (x_high - x_low)
+        mid_y = y_low + rand.random_sample(needed) * (y_high - y_low)
+        angle = rand.random_sample(needed) * np.pi
+        candidates = np.column_stack([
+            mid_x - half * np.cos(angle), mid_y - half * np.sin(angle),
+            mid_x + half * np.cos(angle), mid_y + half * np.sin(angle),
+            ])
+        centre_x = (x_edges[cols] + x_edges[cols + 1]) / 2
+        centre_y = (y_edges[rows] + y_edges[rows + 1]) / 2
+        ok = np.hypot(mid_x - centre_x, mid_y - centre_y) > clearance + half
+        walls = np.concatenate([walls, candidates[ok]])
+    return walls[:count]